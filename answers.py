@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+
+# words that make an article's file name a question
+question_words = frozenset((
+    "are", "can", "could", "do", "does", "how", "is", "should", "what",
+    "when", "where", "which", "who", "why", "will"
+))
+
+
+def canonical_question(file_name: str) -> str:
+    """derives the question an FAQ article answers from its file name, e.g.
+    how-do-i-cancel-a-lesson.txt -> How do I cancel a lesson?"""
+    words = re.split(r"[-_\s]+", os.path.splitext(file_name)[0].strip())
+    words = ["I" if word.lower() == "i" else word for word in words if word]
+
+    if not words:
+        return ""
+
+    question = " ".join(words)
+    question = question[0].upper() + question[1:]
+
+    if words[0].lower() in question_words and not question.endswith("?"):
+        question += "?"
+
+    return question
+
+
+class CanonicalAnswers():
+    """precomputed answers of single-topic FAQ articles
+
+    entries are keyed by "role/file name" and hold the article's content
+    hash, canonical question, paraphrases and answer, so an entry is only
+    regenerated when its article changes. every question and paraphrase is a
+    row of the (normalized) matrix a query is matched against
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.entries: dict[str, dict] = {}
+
+        # keys of the matched entries, the rows of entry i start at
+        # starts[i]
+        self.keys: list[str] = []
+        self.starts: Optional[np.ndarray] = None
+        self.roles: Optional[np.ndarray] = None
+        self.matrix: Optional[np.ndarray] = None
+
+    @classmethod
+    def load(cls, file_path: str) -> "CanonicalAnswers":
+        """loads saved entries, none are loaded if the file is missing or
+        unreadable"""
+        answers = cls(file_path)
+
+        try:
+            with open(file_path, "r") as data_file:
+                answers.entries = json.load(data_file)["entries"]
+        except Exception:
+            pass
+
+        return answers
+
+    def save(self) -> None:
+        """atomically saves the entries, through a temporary file of this
+        process so concurrent saves don't collide"""
+        descriptor, temp_path = tempfile.mkstemp(
+            prefix=f"{os.path.basename(self.file_path)}.",
+            dir=os.path.dirname(os.path.abspath(self.file_path)))
+
+        try:
+            with os.fdopen(descriptor, "w") as data_file:
+                json.dump({"entries": self.entries}, data_file, indent=4)
+            os.replace(temp_path, self.file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def questions(self) -> list[tuple[str, str]]:
+        """returns (entry key, text) of every question and paraphrase, the
+        rows of an entry are consecutive"""
+        return [
+            (key, text) for key, entry in self.entries.items()
+            for text in dict.fromkeys(
+                [entry["question"], *entry["paraphrases"]])]
+
+    def set_vectors(self, row_keys: list[str],
+                    vectors: list[list[float]]) -> None:
+        """sets the embeddings of the questions() rows"""
+        if not row_keys:
+            self.keys, self.matrix = [], None
+            return
+
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(
+            len(row_keys), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+
+        self.keys = list(dict.fromkeys(row_keys))
+        self.starts = np.array(
+            [index for index, key in enumerate(row_keys)
+             if index == 0 or row_keys[index - 1] != key], dtype=np.int64)
+        self.roles = np.array(
+            [self.entries[key]["role"] for key in self.keys])
+        self.matrix = matrix / norms
+
+    def match(self, vector: list[float], role: Optional[str],
+              threshold: float, margin: float) -> Optional[dict]:
+        """returns the entry whose questions best match a query (of a role,
+        or of every role) when its similarity reaches the threshold and
+        leads every other article's by the margin"""
+        if self.matrix is None or not self.keys:
+            return None
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        # an article scores as its best matching question
+        scores = np.maximum.reduceat(self.matrix @ query, self.starts)
+        if role is not None:
+            scores = np.where(self.roles == role, scores, -np.inf)
+
+        if len(scores) > 1:
+            runner_up, best = np.partition(scores, -2)[-2:]
+        else:
+            runner_up, best = -np.inf, scores[0]
+
+        if best < threshold or best - runner_up < margin:
+            return None
+
+        return self.entries[self.keys[int(np.argmax(scores))]]
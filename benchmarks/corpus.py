@@ -0,0 +1,89 @@
+"""deterministic synthetic knowledge base for the benchmarks
+
+writes FAQ style articles to <path>/<role>/<question>.txt, the same seed
+always produces the same files
+
+    python -m benchmarks.corpus ./bench/data_sources --files-per-role 200
+"""
+import argparse
+import os
+import random
+
+
+subjects = [
+    "lesson", "lesson credit", "refund", "referral bonus", "withdrawal",
+    "jitsi classroom", "moderator", "schedule", "subscription", "invoice",
+    "profile", "teacher review", "group class", "trial lesson", "payout",
+    "timezone", "recording", "homework", "certificate", "password"
+]
+
+actions = [
+    "cancel", "reschedule", "request", "update", "join", "pause", "share",
+    "download", "verify", "change", "book", "track"
+]
+
+filler = (
+    "educify keeps every change visible from the dashboard so students and "
+    "teachers always know what happens next. open the settings page, pick "
+    "the item you need and confirm the change. support answers within one "
+    "business day and the help center lists further details. changes made "
+    "less than twenty four hours before a lesson may not be reversible and "
+    "credits are returned to the wallet once the request is approved"
+).split()
+
+
+def article(generator: random.Random, action: str, subject: str,
+            paragraphs: int) -> str:
+    """returns the text of one article"""
+    lines = [f"How do I {action} a {subject}?", ""]
+
+    for _ in range(paragraphs):
+        words = [generator.choice(filler)
+                 for _ in range(generator.randint(40, 120))]
+        # keeps the article's own terms in its body
+        for _ in range(3):
+            words.insert(generator.randrange(len(words)), subject)
+        words.insert(generator.randrange(len(words)), action)
+
+        lines.append(" ".join(words).capitalize() + ".")
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def generate_corpus(path: str, files_per_role: int = 100,
+                    roles: tuple[str, ...] = ("student", "teacher"),
+                    seed: int = 0, max_paragraphs: int = 6) -> int:
+    """writes the corpus and returns the number of files written"""
+    generator = random.Random(seed)
+    written = 0
+
+    for role in roles:
+        os.makedirs(os.path.join(path, role), exist_ok=True)
+
+        for index in range(files_per_role):
+            action = actions[index % len(actions)]
+            subject = subjects[(index // len(actions)) % len(subjects)]
+            file_name = f"how-do-i-{action}-a-{subject.replace(' ', '-')}"
+            if index >= len(actions) * len(subjects):
+                file_name += f"-{index}"
+
+            with open(os.path.join(path, role, f"{file_name}.txt"), "w",
+                      encoding="utf-8") as data_file:
+                data_file.write(article(
+                    generator, action, subject,
+                    generator.randint(1, max_paragraphs)))
+            written += 1
+
+    return written
+
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arguments.add_argument("path")
+    arguments.add_argument("--files-per-role", type=int, default=100)
+    arguments.add_argument("--seed", type=int, default=0)
+    options = arguments.parse_args()
+
+    print(generate_corpus(options.path, options.files_per_role,
+                          seed=options.seed))
@@ -0,0 +1,225 @@
+"""local stand-in for the ollama http api used by the benchmarks
+
+serves /api/chat (streamed or not) and /api/embed with configurable
+latencies so benchmarks measure the chatbot rather than the model
+
+    python -m benchmarks.ollama_stub --port 11435 --tokens-per-second 40
+"""
+import argparse
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# filler words of generated answers
+answer_words = (
+    "you can manage your lessons from the dashboard and contact support "
+    "if anything is unclear").split()
+
+
+def embed(text: str, dimensions: int) -> list[float]:
+    """returns a deterministic hashed bag of words embedding"""
+    vector = [0.0] * dimensions
+
+    for word in re.findall(r"\w+", text.lower()):
+        digest = int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16)
+        vector[digest % dimensions] += 1.0
+
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def schema_instance(schema: dict) -> dict:
+    """returns a value matching a structured output json schema, enums take
+    their first value"""
+    instance = {}
+
+    for name, field in schema.get("properties", {}).items():
+        if "enum" in field:
+            instance[name] = field["enum"][0]
+        elif field.get("type") == "boolean":
+            instance[name] = True
+        elif field.get("type") == "array":
+            instance[name] = [f"{name} {index}" for index in range(3)]
+        else:
+            instance[name] = "ok"
+
+    return instance
+
+
+def keep_alive_seconds(value, default: float = 300.0) -> float:
+    """parses an ollama keep_alive value (seconds or "5m" style)"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value) if value >= 0 else math.inf
+
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+
+    return float(value)
+
+
+class StubState():
+    """latency settings and the models currently "loaded" """
+
+    def __init__(self, options):
+        self.options = options
+        self.loaded_until: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def load(self, model: str, keep_alive) -> None:
+        """sleeps for the load time of models that aren't loaded"""
+        now = time.monotonic()
+
+        with self.lock:
+            self.requests += 1
+            loaded = self.loaded_until.get(model, 0) > now
+            self.loaded_until[model] = now + keep_alive_seconds(keep_alive)
+
+        if not loaded:
+            time.sleep(self.options.load_ms / 1000)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data: dict) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data: dict) -> None:
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):x}\r\n".encode("utf-8") + line + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json({"models": []})
+        else:
+            self.send_json({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        options = self.state.options
+
+        if self.path in ("/api/embed", "/api/embeddings"):
+            self.state.load(body["model"], body.get("keep_alive"))
+
+            texts = body.get("input", body.get("prompt", ""))
+            texts = [texts] if isinstance(texts, str) else texts
+            time.sleep((options.embed_ms +
+                        options.embed_ms_per_input * len(texts)) / 1000)
+
+            vectors = [embed(text, options.embed_dimensions)
+                       for text in texts]
+            if self.path == "/api/embeddings":
+                self.send_json({"embedding": vectors[0]})
+            else:
+                self.send_json({"model": body["model"],
+                                "embeddings": vectors})
+        elif self.path == "/api/chat":
+            self.chat(body)
+        else:
+            self.send_json({})
+
+    def chat(self, body: dict) -> None:
+        options = self.state.options
+        self.state.load(body["model"], body.get("keep_alive"))
+
+        prompt_tokens = sum(
+            len(str(message.get("content", ""))) // 4 + 1
+            for message in body.get("messages", []))
+        max_tokens = (body.get("options") or {}).get(
+            "num_predict") or options.answer_tokens
+
+        schema = body.get("format")
+        if isinstance(schema, dict):
+            tokens = [json.dumps(schema_instance(schema))]
+        else:
+            tokens = [
+                (" " if index else "") + answer_words[
+                    index % len(answer_words)]
+                for index in range(max(int(max_tokens), 1))]
+
+        # prompt evaluation, then generation at the token rate
+        time.sleep((options.first_token_ms +
+                    prompt_tokens / options.prompt_tokens_per_second * 1000)
+                   / 1000)
+        token_delay = 1 / options.tokens_per_second
+
+        done = {
+            "model": body["model"],
+            "created_at": "2024-01-01T00:00:00Z",
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": len(tokens)
+        }
+
+        if not body.get("stream", True):
+            time.sleep(token_delay * len(tokens))
+            self.send_json({**done, "message": {
+                "role": "assistant", "content": "".join(tokens)}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for token in tokens:
+            time.sleep(token_delay)
+            self.send_chunk({
+                "model": body["model"],
+                "created_at": "2024-01-01T00:00:00Z",
+                "message": {"role": "assistant", "content": token},
+                "done": False})
+
+        self.send_chunk({**done, "message": {
+            "role": "assistant", "content": ""}})
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def parser() -> argparse.ArgumentParser:
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arguments.add_argument("--host", default="127.0.0.1")
+    arguments.add_argument("--port", type=int, default=11435)
+    arguments.add_argument("--load-ms", type=float, default=0,
+                           help="model load time after keep_alive expired")
+    arguments.add_argument("--first-token-ms", type=float, default=20)
+    arguments.add_argument("--prompt-tokens-per-second", type=float,
+                           default=2000)
+    arguments.add_argument("--tokens-per-second", type=float, default=200)
+    arguments.add_argument("--answer-tokens", type=int, default=40)
+    arguments.add_argument("--embed-ms", type=float, default=5)
+    arguments.add_argument("--embed-ms-per-input", type=float, default=1)
+    arguments.add_argument("--embed-dimensions", type=int, default=256)
+    return arguments
+
+
+def serve(options) -> ThreadingHTTPServer:
+    """returns the stub server, call serve_forever() to run it"""
+    handler = type("Handler", (StubHandler,), {"state": StubState(options)})
+    server = ThreadingHTTPServer((options.host, options.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    serve(parser().parse_args()).serve_forever()
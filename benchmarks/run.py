@@ -0,0 +1,335 @@
+"""benchmarks the chatbot against the local ollama stub
+
+scenarios:
+    cold_start  import, first index build and restart of ChatBot(), each in
+                a fresh process
+    nodes       latency of router_node, aretrieve and answer_node
+    throughput  /chatbot requests per second and p50/p95/p99 latency per
+                concurrency level
+    sessions    session store memory as sessions accumulate
+
+runs in a temporary directory holding a synthetic corpus and writes the
+results as json
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --scenarios nodes throughput --concurrency 1 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+import httpx
+import numpy as np
+
+from benchmarks.corpus import generate_corpus
+
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scenario_names = ["cold_start", "nodes", "throughput", "sessions"]
+
+# prompts of the node and throughput scenarios, a mix of small talk and
+# knowledge base questions
+prompts = [
+    "hello",
+    "how do I cancel a lesson?",
+    "can I get a refund for a lesson credit?",
+    "how do I reschedule a trial lesson?",
+    "where do I download an invoice?",
+    "tell me a joke",
+    "how do I join the jitsi classroom?",
+    "how do I change my password?"
+]
+
+# runs in a fresh interpreter for the cold start scenario
+cold_start_script = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {repo_path!r})
+from chatbot import ChatBot
+imported = time.perf_counter()
+bot = ChatBot(index_on_init=False, vector_backend={backend!r})
+initialized = time.perf_counter()
+bot.build_index()
+indexed = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - started,
+    "init_seconds": initialized - imported,
+    "index_seconds": indexed - initialized,
+    "total_seconds": indexed - started,
+    "index_state": bot.index_state,
+    "progress": bot.ingestion_stats.summary()
+        if bot.ingestion_stats is not None else None
+}}))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples: list[float]) -> dict:
+    """returns latency statistics of samples (seconds) in milliseconds"""
+    if not samples:
+        return {"count": 0}
+
+    values = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "min_ms": float(values.min()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max())
+    }
+
+
+def start_stub(options) -> subprocess.Popen:
+    """starts the ollama stub and points the ollama clients at it"""
+    port = free_port()
+    stub = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.ollama_stub",
+        "--port", str(port),
+        "--load-ms", str(options.load_ms),
+        "--first-token-ms", str(options.first_token_ms),
+        "--tokens-per-second", str(options.tokens_per_second),
+        "--answer-tokens", str(options.answer_tokens),
+        "--embed-ms", str(options.embed_ms)
+        ], cwd=repo_path)
+
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{port}"
+
+    for _ in range(100):
+        try:
+            httpx.get(f"{os.environ['OLLAMA_HOST']}/api/tags")
+            return stub
+        except httpx.TransportError:
+            time.sleep(0.05)
+
+    stub.kill()
+    raise Exception("the ollama stub didn't start")
+
+
+def cold_start(options) -> dict:
+    """times a first index build and a restart on the built index"""
+    script = cold_start_script.format(
+        repo_path=repo_path, backend=options.backend)
+    results = {}
+
+    for run in ("first_build", "restart"):
+        completed = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True,
+            env=os.environ.copy())
+        if completed.returncode != 0:
+            raise Exception(completed.stderr)
+
+        # the chatbot prints progress before the result
+        results[run] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    return results
+
+
+async def nodes(options) -> dict:
+    """times the graph nodes on their own, outside of the graph"""
+    from langchain_core.messages import HumanMessage
+    from chatbot import ChatBot
+
+    bot = ChatBot(vector_backend=options.backend)
+    await bot.awarmup()
+
+    samples = {"router_node": [], "aretrieve": [], "answer_node": []}
+    for repeat in range(options.repeats):
+        prompt = prompts[repeat % len(prompts)]
+        config = {"configurable": {
+            "role": ("student", "teacher")[repeat % 2]}}
+
+        started = time.perf_counter()
+        await bot.router_node({"messages": [HumanMessage(prompt)]}, config)
+        samples["router_node"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await bot.aretrieve({"messages": [HumanMessage(prompt)]}, config)
+        samples["aretrieve"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await bot.answer_node({"messages": [HumanMessage(prompt)]}, config)
+        samples["answer_node"].append(time.perf_counter() - started)
+
+    return {node: percentiles(node_samples)
+            for node, node_samples in samples.items()}
+
+
+async def throughput(options) -> dict:
+    """drives /chatbot at each concurrency level through the asgi app"""
+    import main
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+
+    async with main.lifespan(main.app), httpx.AsyncClient(
+            transport=transport, base_url="http://bench",
+            timeout=None) as client:
+        while main.bot_init is None or not main.bot_init.warmed_up or (
+                main.bot_init.index_state not in ("ready", "failed")):
+            await asyncio.sleep(0.1)
+
+        for concurrency in options.concurrency:
+            latencies = []
+            statuses = {}
+            queue = asyncio.Queue()
+            for index in range(options.requests):
+                queue.put_nowait(index)
+
+            async def worker():
+                while not queue.empty():
+                    index = queue.get_nowait()
+                    started = time.perf_counter()
+                    response = await client.post("/chatbot", json={
+                        "user_id": "bench",
+                        "role": ("student", "teacher")[index % 2],
+                        "prompt": prompts[index % len(prompts)]})
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status_code] = statuses.get(
+                        response.status_code, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            elapsed = time.perf_counter() - started
+
+            results[str(concurrency)] = {
+                "requests": options.requests,
+                "seconds": elapsed,
+                "requests_per_second": options.requests / elapsed,
+                "statuses": {str(status): count
+                             for status, count in statuses.items()},
+                "latency": percentiles(latencies)
+            }
+
+    return results
+
+
+async def sessions(options) -> dict:
+    """records the session store size as single turn sessions are added"""
+    from chatbot import ChatBot
+
+    bot = ChatBot(vector_backend=options.backend)
+    graph = bot.acompile()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    results = []
+    created = 0
+
+    for checkpoint in sorted(options.sessions):
+        while created < checkpoint:
+            # sessions are opened at the highest concurrency level
+            opened = min(max(options.concurrency), checkpoint - created)
+            await asyncio.gather(*[graph.ainvoke(
+                {"messages": prompts[(created + index) % len(prompts)]},
+                {"configurable": {"thread_id": str(uuid.uuid4()),
+                                  "role": "student"}})
+                for index in range(opened)])
+            created += opened
+
+        store = bot.memory.stats()
+        results.append({
+            "sessions": created,
+            "active_sessions": store.get("active_sessions"),
+            "approx_bytes": store.get("approx_bytes"),
+            "traced_bytes": tracemalloc.get_traced_memory()[0] - baseline
+        })
+
+    tracemalloc.stop()
+    return {"checkpoints": results}
+
+
+def parser() -> argparse.ArgumentParser:
+    arguments = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arguments.add_argument("--output", default="benchmark-results.json")
+    arguments.add_argument("--scenarios", nargs="+", default=scenario_names,
+                           choices=scenario_names)
+    arguments.add_argument("--backend", default="chroma",
+                           choices=["chroma", "numpy"])
+    arguments.add_argument("--files-per-role", type=int, default=100)
+    arguments.add_argument("--seed", type=int, default=0)
+    arguments.add_argument("--repeats", type=int, default=50,
+                           help="calls per node")
+    arguments.add_argument("--concurrency", type=int, nargs="+",
+                           default=[1, 4, 16])
+    arguments.add_argument("--requests", type=int, default=100,
+                           help="requests per concurrency level")
+    arguments.add_argument("--sessions", type=int, nargs="+",
+                           default=[0, 100, 500, 1000])
+    # ollama stub latencies
+    arguments.add_argument("--load-ms", type=float, default=0)
+    arguments.add_argument("--first-token-ms", type=float, default=20)
+    arguments.add_argument("--tokens-per-second", type=float, default=200)
+    arguments.add_argument("--answer-tokens", type=int, default=40)
+    arguments.add_argument("--embed-ms", type=float, default=5)
+    return arguments
+
+
+def main() -> None:
+    options = parser().parse_args()
+    output = os.path.abspath(options.output)
+
+    results = {
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(options),
+        "scenarios": {}
+    }
+
+    stub = start_stub(options)
+    try:
+        with tempfile.TemporaryDirectory(prefix="edubot-bench-") as workdir:
+            # the chatbot resolves its data, index and cache paths from the
+            # working directory
+            os.chdir(workdir)
+            sys.path.insert(0, repo_path)
+            os.environ["EDUBOT_VECTOR_BACKEND"] = options.backend
+
+            results["corpus_files"] = generate_corpus(
+                os.path.join(workdir, "data_sources"),
+                options.files_per_role, seed=options.seed)
+
+            scenarios = {"cold_start": cold_start, "nodes": nodes,
+                         "throughput": throughput, "sessions": sessions}
+            for name in scenario_names:
+                if name not in options.scenarios:
+                    continue
+
+                print(f"running {name}")
+                started = time.perf_counter()
+                result = scenarios[name](options)
+                if asyncio.iscoroutine(result):
+                    result = asyncio.run(result)
+                result["seconds"] = time.perf_counter() - started
+                results["scenarios"][name] = result
+
+            os.chdir(repo_path)
+    finally:
+        stub.terminate()
+
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
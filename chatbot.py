@@ -1,22 +1,37 @@
+import asyncio
 import os
-import shutil  # noqa
+import shutil
+import threading
+import time
+from collections import OrderedDict
 from typing import Annotated, TypedDict, Optional, Literal  # noqa
 
+import httpx
+import numpy as np
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import (
-    DirectoryLoader, TextLoader, PyMuPDFLoader, CSVLoader)
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 from langgraph.graph.message import add_messages
 from langgraph.graph import StateGraph, START, END  # noqa
-from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, ToolMessage  # noqa
+from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, ToolMessage, RemoveMessage  # noqa
 from pydantic import BaseModel, Field  # noqa
 from langgraph.checkpoint.memory import MemorySaver  # noqa
 # from langchain_core.tools import tool
 
-from utils import save_to_json, load_from_json, ExpiringMemorySaver
+from answers import CanonicalAnswers, canonical_question
+from embeddings import CachedEmbeddings
+from metrics import (
+    node_seconds, llm_seconds, llm_queue_seconds, prompt_tokens,
+    completion_tokens, retrieved_chunks, routes, search_seconds, add_timing)
+from retrieval import (
+    BM25Index, NumpyVectorStore, is_decisive, reciprocal_rank_fusion,
+    build_context)
+from ingestion import (
+    document_loaders, load_file, iter_chunks, batched, IngestionStats)
+from utils import (
+    load_manifest, save_manifest, manifest_digest, diff_directory,
+    ResponseCache, ExpiringMemorySaver, SQLiteExpiringSaver, index_lock,
+    ConcurrencyLimiter, estimate_tokens, directory_signature)
 
 
 class RouteDecision(BaseModel):
@@ -29,11 +44,24 @@ class RagJudge(BaseModel):
     sufficient: bool
 
 
+class Paraphrases(BaseModel):
+    """paraphrase generator output schema"""
+    questions: list[str]
+
+
 class BotState(TypedDict):
     """handles how data's state is structured throughout the workflow"""
     context: Optional[list[Document]]
     route: Optional[Literal["rag", "answer", "end"]]
     messages: Annotated[list[BaseMessage], add_messages]
+    # user question of a cacheable (first) turn
+    question: Optional[str]
+    # similarity margin of an embedding route decision, None for the llm
+    route_confidence: Optional[float]
+    # rolling summary of the turns trimmed from the history
+    summary: Optional[str]
+    # vector relevance scores of the context, None for a lexical match
+    relevance: Optional[list[float]]
 
 
 class ChatBot():
@@ -70,6 +98,50 @@ class ChatBot():
     question: {question}
     """
 
+    # examples of queries answered directly, knowledge base topics are taken
+    # from the indexed file names
+    small_talk_examples = [
+        "hi", "hello", "hey there", "good morning", "good afternoon",
+        "good evening", "how are you?", "what's up?", "who are you?",
+        "what is your name?", "what can you do?", "thanks", "thank you",
+        "thank you so much", "ok", "okay", "great", "cool", "bye",
+        "goodbye", "see you later", "nice to meet you", "you are helpful",
+        "tell me a joke"
+    ]
+
+    summary_template = """
+    Summarize the conversation below between a user and EduBot, a support
+    chatbot for educify. Keep names, facts, decisions and open questions,
+    drop greetings. Extend the existing summary if there is one.
+    Make the summary as short as possible.
+
+    existing summary: {summary}
+
+    conversation:
+    {conversation}
+    """
+
+    paraphrase_template = """
+    Write {count} different ways a {role} on educify could ask the question
+    below. Vary the wording, keep the meaning.
+
+    question: {question}
+    """
+
+    canonical_answer_template = """
+    You are EduBot, the support chatbot of educify. Answer the question of
+    a {role} using only the article below.
+
+    article: {article}
+
+    question: {question}
+
+    Instructions:
+    - Be concise, helpful, and professional
+    - Don't mention the article
+    - Make your response as short as possible.
+    """
+
     retrieval_judge_template = """
     You are a judge evaluating if the retrieved information is sufficient
     to answer the user's question. Consider both relevance and completeness.
@@ -81,39 +153,161 @@ class ChatBot():
     Is this sufficient to answer the question?
     """
 
+    # supported knowledge source formats
+    document_extensions = document_loaders
+
+    # written by indexing before the manifest (next to it), removed once a
+    # manifest replaces them
+    legacy_index_paths = ("tracked_student.json", "tracked_teacher.json",
+                          "student_vector_store", "teacher_vector_store")
+
     def __init__(self,
-                 # data_path: str = "./data_sources",
-                 student_data_path: str = "./data_sources/student",
-                 teacher_data_path: str = "./data_sources/teacher",
+                 data_path: str = "./data_sources",
                  db_location: str = "./vector_store",
-                 student_db_location: str = "./student_vector_store",
-                 teacher_db_location: str = "./teacher_vector_store",
+                 collection_name: str = "edubot",
+                 manifest_path: str = "./manifest.json",
                  llm: str = "llama3.2:3b",
                  embedding_model: str = "mxbai-embed-large:335m",
+                 embedding_cache_path: str = "./embedding_cache.sqlite",
+                 embedding_batch_size: int = 64,
+                 query_cache_size: int = 1024,
+                 chunk_size: int = 1000,
+                 chunk_overlap: int = 200,
+                 ingestion_workers: Optional[int] = None,
+                 response_cache: bool = False,
+                 response_cache_threshold: float = 0.95,
+                 response_cache_ttl: int = 3600,
+                 response_cache_size: int = 1024,
+                 router_mode: Literal["llm", "embedding"] = "llm",
+                 router_margin: float = 0.05,
+                 speculative_retrieval: bool = False,
+                 history_token_budget: int = 2000,
+                 checkpointer: Literal["memory", "sqlite"] = "memory",
+                 checkpoint_path: str = "./sessions.sqlite",
+                 session_ttl: int = 600,
+                 max_sessions: Optional[int] = None,
+                 max_session_bytes: Optional[int] = None,
+                 llm_concurrency: int = 4,
+                 llm_queue_size: int = 32,
+                 llm_queue_timeout: float = 30.0,
+                 keep_alive: int = 1800,
+                 ollama_pool_size: int = 16,
+                 index_on_init: bool = True,
+                 reindex_debounce: float = 2.0,
+                 reindex_interval: float = 30.0,
+                 watch_interval: float = 0,
+                 hybrid_retrieval: bool = True,
+                 vector_k: int = 4,
+                 bm25_k: int = 4,
+                 context_k: int = 4,
+                 rrf_k: int = 60,
+                 lexical_fast_path: float = 1.5,
+                 lexical_min_score: float = 10.0,
+                 vector_backend: Literal["chroma", "numpy"] = "chroma",
+                 context_token_budget: int = 1500,
+                 retrieval_gate: bool = True,
+                 relevance_threshold: float = 0.5,
+                 relevance_margin: float = 0.1,
+                 judge_band: float = 0.15,
+                 canonical_answers: bool = False,
+                 canonical_answers_path: str = "./canonical_answers.json",
+                 canonical_threshold: float = 0.9,
+                 canonical_margin: float = 0.05,
+                 paraphrase_count: int = 4,
                  ):
-        # self.data_path = data_path
-        self.student_data_path = student_data_path
-        self.teacher_data_path = teacher_data_path
+        # every sub-directory of data_path holds the knowledge sources of
+        # one audience (role), e.g. ./data_sources/student
+        self.data_path = data_path
 
         self.db_location = db_location
-        self.student_db_location = student_db_location
-        self.teacher_db_location = teacher_db_location
-
-        # Initialize the graph's memory saver
-        # change later to a persistent saver to save chat history
+        # "numpy" keeps embeddings in a memory mapped matrix instead of
+        # chroma, better suited to small knowledge bases and many workers
+        self.vector_backend = vector_backend
+        self.collection_name = collection_name
+        self.manifest_path = manifest_path
+
+        # Initialize the graph's memory saver, "sqlite" persists sessions
+        # and shares them between worker processes
         # self.memory = MemorySaver()
-        self.memory = ExpiringMemorySaver(inactivity_ttl=600)  # set to 3600
+        if checkpointer == "sqlite":
+            self.memory = SQLiteExpiringSaver(
+                inactivity_ttl=session_ttl, file_path=checkpoint_path)
+        else:
+            self.memory = ExpiringMemorySaver(
+                inactivity_ttl=session_ttl,
+                max_sessions=max_sessions,
+                max_bytes=max_session_bytes)
+
+        # seconds ollama keeps both models loaded after their last request,
+        # -1 keeps them loaded for good
+        self.keep_alive = keep_alive
+        # the chat and embedding models each share one pooled http client
+        # that keeps its connections to ollama open between requests
+        self.client_kwargs = {"limits": httpx.Limits(
+            max_connections=ollama_pool_size,
+            max_keepalive_connections=ollama_pool_size,
+            keepalive_expiry=60)}
+        self.warmed_up = False
 
         try:
-            self.llm = ChatOllama(model=llm)
+            self.llm = ChatOllama(
+                model=llm, keep_alive=self.keep_alive,
+                client_kwargs=self.client_kwargs)
         except Exception as e:
             raise Exception(e.args)
 
-        self.router_llm = self.llm.with_structured_output(RouteDecision)
-        self.judge_llm = self.llm.with_structured_output(RagJudge)
+        # the raw messages of structured outputs carry the token counts
+        self.router_llm = self.llm.with_structured_output(
+            RouteDecision, include_raw=True)
+        self.judge_llm = self.llm.with_structured_output(
+            RagJudge, include_raw=True)
         self.answer_llm = self.llm
+        self.paraphrase_llm = self.llm.with_structured_output(Paraphrases)
+
+        # every llm call waits for one of llm_concurrency slots so a burst
+        # doesn't pile up on the ollama server
+        self.llm_limiter = ConcurrencyLimiter(
+            max_concurrency=llm_concurrency,
+            max_queue=llm_queue_size,
+            queue_timeout=llm_queue_timeout)
 
         self.embedding_model = embedding_model
+        self.embedding_cache_path = embedding_cache_path
+        self.embedding_batch_size = embedding_batch_size
+        self.query_cache_size = query_cache_size
+        self.embeddings = None
+
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        # defaults to one ingestion process per core
+        self.ingestion_workers = ingestion_workers
+        self.ingestion_stats = None
+
+        # "embedding" routes by similarity to the small talk and knowledge
+        # base centroids, falling back to the llm below router_margin
+        self.router_mode = router_mode
+        self.router_margin = router_margin
+        self.router_centroids = None
+        self.kb_topics = []
+
+        # retrieves context in parallel with routing, turn it off where the
+        # vector store rather than the router llm is the bottleneck
+        self.speculative_retrieval = speculative_retrieval
+
+        # older turns beyond the budget are folded into a rolling summary
+        self.history_token_budget = history_token_budget
+        # thread id -> (summary task, the trimmed messages it folds in) not
+        # yet picked up by the thread's next turn
+        self.summary_tasks = {}
+        self.graph = None
+        # checkpointer-less graph answering batches
+        self.batch_graph = None
+
+        # opt-in semantic cache of first-turn answers
+        self.response_cache = ResponseCache(
+            threshold=response_cache_threshold,
+            ttl=response_cache_ttl,
+            max_size=response_cache_size) if response_cache else None
 
         self.querying_template = ChatPromptTemplate.from_template(
             ChatBot.query_template)
@@ -121,203 +315,1145 @@ class ChatBot():
             ChatBot.router_template)
         self.retrieval_judging_template = ChatPromptTemplate.from_template(
             ChatBot.retrieval_judge_template)
+        self.summarizing_template = ChatPromptTemplate.from_template(
+            ChatBot.summary_template)
+        self.paraphrasing_template = ChatPromptTemplate.from_template(
+            ChatBot.paraphrase_template)
+        self.canonical_answering_template = ChatPromptTemplate.from_template(
+            ChatBot.canonical_answer_template)
+
+        # a persisted index tracked by the manifest is served (and searched)
+        # while it's brought up to date, without one queries are answered
+        # without retrieval until the first index is built
+        self.chroma_client = None
+        # (collection name, vector store, BM25 index) being served, published
+        # as one tuple so a search never mixes two generations
+        self.serving = None
+        self.swap_lock = threading.Lock()
+        # identity of the manifest file last read for the served collection
+        self.manifest_stat = None
+
+        # vector hits are fused with BM25 hits by reciprocal rank fusion,
+        # a BM25 top hit scoring at least lexical_min_score and
+        # lexical_fast_path times better than the runner-up is used without
+        # a vector search (0 turns the fast path off)
+        self.hybrid_retrieval = hybrid_retrieval
+        self.vector_k = vector_k
+        self.bm25_k = bm25_k
+        self.context_k = context_k
+        self.rrf_k = rrf_k
+        self.lexical_fast_path = lexical_fast_path
+        self.lexical_min_score = lexical_min_score
+
+        # retrieved chunks are merged per source and capped at the budget,
+        # short sources are included whole
+        self.context_token_budget = context_token_budget
+        # (knowledge base version, source) -> source text
+        self.source_texts = OrderedDict()
+
+        # retrievals scoring below relevance_threshold are widened once and
+        # then dropped, the judge llm only decides scores in the judge_band
+        # below the threshold whose lead is under relevance_margin
+        self.retrieval_gate = retrieval_gate
+        self.relevance_threshold = relevance_threshold
+        self.relevance_margin = relevance_margin
+        self.judge_band = judge_band
+        self.gate_stats = {"scored": 0, "judged": 0, "widened": 0,
+                           "dropped": 0}
+
+        # first-turn questions matching an FAQ article's canonical question
+        # (or a paraphrase of it) by canonical_threshold, and leading other
+        # articles by canonical_margin, get the article's precomputed answer.
+        # the answers are generated while indexing
+        self.canonical_answers_enabled = canonical_answers
+        self.canonical_answers_path = canonical_answers_path
+        self.canonical_threshold = canonical_threshold
+        self.canonical_margin = canonical_margin
+        self.paraphrase_count = paraphrase_count
+        self.canonical_answers = None
+
+        self.index_state = "pending"
+        self.index_error = None
+        self.files_to_index = 0
+
+        # reindex requests are debounced and at most one reindex runs every
+        # reindex_interval seconds, a watch_interval polls data_path for
+        # changes
+        self.reindex_debounce = reindex_debounce
+        self.reindex_interval = reindex_interval
+        self.watch_interval = watch_interval
+        self.reindex_requested = None
+        self.last_reindex = None
+        self.reindex_event = asyncio.Event()
+
+        manifest = load_manifest(self.manifest_path)
+        if manifest["collection"] is not None and (
+                os.path.exists(self.db_location)) and (
+                self.is_compatible(manifest)):
+            self.swap_vector_store(manifest["collection"])
+        self.load_index_metadata(manifest)
+
+        if index_on_init:
+            self.build_index()
+
+            if self.canonical_answers_enabled:
+                # their llm calls need the event loop's limiter
+                print("Canonical answers are only precomputed by "
+                      "abuild_index, skipped")
 
-        # documents_directory = os.listdir(self.data_path)
-        student_documents_directory = os.listdir(self.student_data_path)
-        teacher_documents_directory = os.listdir(self.teacher_data_path)
-
-        # tracked_documents = load_from_json()
-        tracked_student_documents = load_from_json(
-            file_path="./tracked_student.json")
-        tracked_teacher_documents = load_from_json(
-            file_path="./tracked_teacher.json")
-
-        if (sorted(student_documents_directory) != sorted(
-                tracked_student_documents)) and (
-                    sorted(teacher_documents_directory) != sorted(
-                        tracked_teacher_documents)):
-            chunks = self.run()
-
-            # ensures vectorizing is done only once on document update
-            self.vector_store = self.save_to_chroma(
-                chunks[0], db_location=self.db_location)
-            self.vector_store = self.save_to_chroma(
-                chunks[1], db_location=self.db_location)
-
-            self.student_vector_store = self.save_to_chroma(
-                chunks[0], db_location=self.student_db_location)
-            self.teacher_vector_store = self.save_to_chroma(
-                chunks[1], db_location=self.teacher_db_location)
+    def initialize_embedding(self):
+        """returns chatbot's embedding model used for vectorizing chunks
 
-        else:
-            # initializes chroma clients
-            self.vector_store = Chroma(
-                persist_directory=self.db_location,
-                embedding_function=self.initialize_embedding()
-            )
-            self.student_vector_store = Chroma(
-                persist_directory=self.student_db_location,
-                embedding_function=self.initialize_embedding()
-            )
-            self.teacher_vector_store = Chroma(
-                persist_directory=self.teacher_db_location,
-                embedding_function=self.initialize_embedding()
-            )
+        the model is created once and wrapped in a persistent embedding cache
+        shared by every vector store and query
+        """
+        if self.embeddings is not None:
+            return self.embeddings
 
-    def initialize_embedding(self):
-        """returns chatbot's embedding model used for vectorizing chunks"""
         try:
-            return OllamaEmbeddings(model=self.embedding_model)
+            self.embeddings = CachedEmbeddings(
+                OllamaEmbeddings(
+                    model=self.embedding_model, keep_alive=self.keep_alive,
+                    client_kwargs=self.client_kwargs),
+                model=self.embedding_model,
+                cache_path=self.embedding_cache_path,
+                batch_size=self.embedding_batch_size,
+                query_cache_size=self.query_cache_size)
         except Exception as e:
             raise Exception(e.args)
 
-    def initialize_text_splitter(self):
-        """returns chatbot's recursive character text
-            splitter used for chunking"""
+        return self.embeddings
+
+    def get_chroma_client(self):
+        """returns the persistent chroma client shared by every collection"""
+        if self.chroma_client is None:
+            try:
+                # imported on demand, the numpy backend doesn't need chroma
+                import chromadb
+
+                self.chroma_client = chromadb.PersistentClient(
+                    path=self.db_location)
+            except Exception as e:
+                raise Exception(e.args)
+
+        return self.chroma_client
+
+    def open_vector_store(self, collection_name: str):
+        """returns a collection of the vector backend, a single collection
+        holds every role's chunks tagged with a "role" metadata field"""
+        if self.vector_backend == "numpy":
+            os.makedirs(self.db_location, exist_ok=True)
+            return NumpyVectorStore.load(
+                self.initialize_embedding(), self.db_location,
+                collection_name)
+
         try:
-            return RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=200,
-                length_function=len,
-                add_start_index=True
+            from langchain_chroma import Chroma
+
+            return Chroma(
+                client=self.get_chroma_client(),
+                collection_name=collection_name,
+                embedding_function=self.initialize_embedding(),
+                collection_metadata={"hnsw:space": "cosine"}
             )
         except Exception as e:
             raise Exception(e.args)
 
-    def load_documents(self, data_path: str):
-        """loads knowledge sources into a list of 'Document' objects
+    @property
+    def active_collection(self) -> Optional[str]:
+        return self.serving[0] if self.serving is not None else None
+
+    @property
+    def vector_store(self):
+        return self.serving[1] if self.serving is not None else None
+
+    @property
+    def bm25(self) -> Optional[BM25Index]:
+        return self.serving[2] if self.serving is not None else None
+
+    def swap_vector_store(self, collection_name: str):
+        """points retrieval at another collection
 
-        load documents from a directory (supported formats .pdf, .md, .txt)
+        requests already searching keep their reference to the previous
+        collection, a request finding it deleted switches to the current one
         """
-        # handle
-        # only stores new sources
-        # include web scraper
-
-        # data_path = self.data_path
-        documents = []
-
-        document_extensions = {
-            ".pdf": PyMuPDFLoader,
-            ".md": TextLoader,
-            ".txt": TextLoader,
-            ".csv": CSVLoader
-            }
+        with self.swap_lock:
+            if collection_name != self.active_collection:
+                bm25 = self.load_bm25(
+                    collection_name) if self.hybrid_retrieval else None
+
+                self.serving = (
+                    collection_name, self.open_vector_store(collection_name),
+                    bm25)
+
+    def refresh_index(self, force: bool = False):
+        """switches to the manifest's collection when another worker wrote a
+        new one and returns what's served
 
-        for extension, loader_class in document_extensions.items():
-            loader = DirectoryLoader(
-                data_path, glob=f"*{extension}",
-                loader_cls=(
-                    loader_class if extension == ".pdf" else (
-                        lambda path: loader_class(
-                            path, encoding="utf-8"))),
-                show_progress=True)
-            documents.extend(loader.load())
-
-        return documents
-
-    def save_to_chroma(self, chunks: list[Document], db_location):
-        """returns a chroma client used to query the vector database"""
-        # handle
+        the manifest is only read again once its file changed, or when force
+        is set (e.g. after the served collection was deleted)
+        """
         try:
-            # Clear out the database first.
-            # if os.path.exists(db_location):
-            #     shutil.rmtree(db_location)
-
-            db = Chroma.from_documents(
-                documents=chunks,
-                embedding=self.initialize_embedding(),
-                persist_directory=db_location
-            )
+            stat = os.stat(self.manifest_path)
+        except OSError:
+            return self.serving
+
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self.manifest_stat and not force:
+            return self.serving
+
+        self.manifest_stat = identity
+        manifest = load_manifest(self.manifest_path)
+
+        if manifest["collection"] is not None and (
+                manifest["collection"] != self.active_collection) and (
+                self.is_compatible(manifest)):
+            self.swap_vector_store(manifest["collection"])
+            self.load_index_metadata(manifest)
+
+        return self.serving
+
+    def is_compatible(self, manifest: dict) -> bool:
+        """whether a manifest's collection was written with the chatbot's
+        vector backend and embedding model, manifests predating the model
+        field are assumed to match"""
+        return manifest.get("backend", "chroma") == self.vector_backend and (
+            manifest.get("embedding_model", self.embedding_model) ==
+            self.embedding_model)
+
+    def remove_legacy_index(self):
+        """deletes the tracked_*.json lists and per-role vector stores of
+        indexing runs that predate the manifest"""
+        base = os.path.dirname(os.path.abspath(self.manifest_path))
+
+        for name in ChatBot.legacy_index_paths:
+            path = os.path.join(base, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def bm25_path(self, collection_name: str) -> str:
+        """returns where the BM25 index of a collection is persisted"""
+        return os.path.join(self.db_location, f"{collection_name}.bm25.json")
+
+    def load_bm25(self, collection_name: str) -> BM25Index:
+        """returns the persisted BM25 index of a collection, it's built from
+        the collection's chunks when missing"""
+        if collection_name == self.active_collection and (
+                self.bm25 is not None):
+            return self.bm25
+
+        bm25 = BM25Index.load(self.bm25_path(collection_name))
+
+        if bm25 is None:
+            if self.vector_backend == "numpy":
+                store = NumpyVectorStore.load(
+                    self.initialize_embedding(), self.db_location,
+                    collection_name)
+                ids, documents = store.ids, store.documents
+            else:
+                chunks = self.get_chroma_client().get_collection(
+                    collection_name).get(include=["documents", "metadatas"])
+                ids = chunks["ids"]
+                documents = [
+                    {"page_content": page_content, "metadata": metadata}
+                    for page_content, metadata in zip(
+                        chunks["documents"], chunks["metadatas"])]
+
+            bm25 = BM25Index()
+            bm25.add(ids, [
+                Document(page_content=document["page_content"],
+                         metadata=document["metadata"] or {})
+                for document in documents])
+            bm25.save(self.bm25_path(collection_name))
+
+        return bm25
+
+    def prune_collections(self, current: Optional[str]):
+        """deletes the chatbot's collections other than current and the
+        generation before it, which other workers and in-flight requests
+        may still be searching. leftovers of interrupted builds are deleted
+        too"""
+        prefix = f"{self.collection_name}-v"
+        keep = set()
+
+        if current is not None:
+            generation = int(current[len(prefix):])
+            keep = {current, f"{prefix}{generation - 1}"}
+
+        if self.vector_backend == "numpy":
+            os.makedirs(self.db_location, exist_ok=True)
+
+            for file_name in os.listdir(self.db_location):
+                if file_name.startswith(prefix) and (
+                        file_name.split(".", 1)[0] not in keep):
+                    os.remove(os.path.join(self.db_location, file_name))
+            return
+
+        client = self.get_chroma_client()
+
+        for collection in client.list_collections():
+            if collection.name.startswith(prefix) and (
+                    collection.name not in keep):
+                client.delete_collection(collection.name)
+
+                if os.path.exists(self.bm25_path(collection.name)):
+                    os.remove(self.bm25_path(collection.name))
+
+    def copy_chunks(self, source_name: str, target_name: str,
+                    chunk_ids: list[str], vector_store=None,
+                    batch_size: int = 1000):
+        """copies chunks with their stored embeddings from one collection
+        to another, nothing is embedded again
+
+        numpy stores are only written once complete so their chunks are
+        copied to the target's vector_store
+        """
+        if self.vector_backend == "numpy":
+            ids, vectors, documents = NumpyVectorStore.load(
+                self.initialize_embedding(), self.db_location,
+                source_name).get(chunk_ids)
+            vector_store.add_vectors(ids, vectors, documents)
+            return
+
+        client = self.get_chroma_client()
+        source = client.get_collection(source_name)
+        target = client.get_collection(target_name)
+
+        for start in range(0, len(chunk_ids), batch_size):
+            chunks = source.get(
+                ids=chunk_ids[start:start + batch_size],
+                include=["embeddings", "documents", "metadatas"])
+            if chunks["ids"]:
+                target.add(ids=chunks["ids"],
+                           embeddings=chunks["embeddings"],
+                           documents=chunks["documents"],
+                           metadatas=chunks["metadatas"])
+
+    def build_index(self) -> dict:
+        """brings the vector store up to date with the knowledge sources and
+        returns the manifest
+
+        other workers sharing the vector store wait for the index to be up to
+        date instead of building it concurrently and switch to the collection
+        it was written to. the served collection (if any) is only swapped
+        once the new one is complete. canonical answers are precomputed by
+        abuild_index
+        """
+        self.index_state = "indexing"
+        self.index_error = None
+
+        try:
+            with index_lock(f"{self.manifest_path}.lock"):
+                manifest = load_manifest(self.manifest_path)
+
+                if not self.is_compatible(manifest):
+                    # another backend's chunks (or another model's
+                    # embeddings) can't be copied over so every file is
+                    # indexed again
+                    manifest["files"] = {}
+                    manifest["collection"] = None
+
+                if manifest["collection"] is None and (
+                        self.chroma_client is None) and (
+                        os.path.exists(self.db_location)):
+                    # no (or outdated) manifest, chunks already in the store
+                    # can't be tracked so the store is rebuilt from scratch
+                    shutil.rmtree(self.db_location)
 
-            return db
+                previous = manifest["collection"]
+
+                # ensures only added or changed documents are vectorized
+                manifest = self.run(manifest)
+                self.swap_vector_store(manifest["collection"])
+
+                if manifest["collection"] != previous:
+                    self.prune_collections(manifest["collection"])
+
+                self.remove_legacy_index()
         except Exception as e:
+            self.index_state = "failed"
+            self.index_error = str(e)
             raise Exception(e.args)
+        finally:
+            self.last_reindex = time.monotonic()
+
+        self.index_state = "ready"
+        return manifest
+
+    async def abuild_index(self):
+        """builds the index in a worker thread, leaving the event loop free
+        to serve requests, then precomputes the canonical answers on the
+        event loop where their llm calls share the concurrency limiter"""
+        manifest = await asyncio.to_thread(self.build_index)
+
+        if self.canonical_answers_enabled:
+            await self.aprecompute_answers(manifest)
+
+    def request_reindex(self):
+        """schedules a reindex, bursts of requests result in a single one"""
+        self.reindex_requested = time.monotonic()
+        self.reindex_event.set()
+
+    async def areindex_worker(self):
+        """runs requested reindexes one at a time
+
+        a reindex starts reindex_debounce seconds after the latest request
+        and no sooner than reindex_interval seconds after the previous one,
+        requests made while indexing trigger one more reindex
+        """
+        while True:
+            await self.reindex_event.wait()
+
+            while (delay := self.reindex_requested + self.reindex_debounce
+                    - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+            if self.last_reindex is not None and (
+                    delay := self.last_reindex + self.reindex_interval
+                    - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+            self.reindex_event.clear()
+            try:
+                await self.abuild_index()
+            except Exception as e:
+                print(f"Reindexing failed: {e}")
+
+    async def awatch(self):
+        """polls the knowledge sources every watch_interval seconds,
+        requesting a reindex when they changed or when another worker
+        switched to a new collection"""
+        extensions = tuple(ChatBot.document_extensions)
+        signature = await asyncio.to_thread(
+            directory_signature, self.data_path, extensions)
+
+        while True:
+            await asyncio.sleep(self.watch_interval)
+
+            current = await asyncio.to_thread(
+                directory_signature, self.data_path, extensions)
+            collection = (await asyncio.to_thread(
+                load_manifest, self.manifest_path))["collection"]
+
+            if current != signature or (
+                    collection is not None and
+                    collection != self.active_collection and
+                    self.index_state != "indexing" and
+                    not self.reindex_event.is_set()):
+                signature = current
+                self.request_reindex()
+
+    def index_progress(self) -> dict:
+        """returns the indexing state and throughput"""
+        progress = {
+            "state": self.index_state,
+            # whether retrieval is available
+            "serving": self.vector_store is not None,
+            "collection": self.active_collection,
+            "reindex_pending": self.reindex_event.is_set(),
+            "files_total": self.files_to_index
+        }
+
+        if self.ingestion_stats is not None:
+            progress.update(self.ingestion_stats.summary())
+        if self.index_error is not None:
+            progress["error"] = self.index_error
+
+        return progress
+
+    def get_roles(self) -> list[str]:
+        """returns the roles (audiences) that have a knowledge source
+        directory"""
+        return sorted(
+            entry.name for entry in os.scandir(self.data_path)
+            if entry.is_dir())
+
+    def load_document(self, file_path: str):
+        """loads a single knowledge source into a list of 'Document' objects"""
+        return load_file(file_path)
+
+    def save_to_chroma(self, chunks: list[Document], ids: list[str],
+                       vector_store=None):
+        """adds chunks to the chroma collection under stable ids"""
+        if not chunks:
+            return
+
+        if vector_store is None:
+            vector_store = self.vector_store
+
+        try:
+            vector_store.add_documents(documents=chunks, ids=ids)
+        except Exception as e:
+            raise Exception(e.args)
+
+    def run(self, manifest: Optional[dict] = None):
+        """runs the incremental indexing process: loading + splitting +
+        chunking of added or changed documents, callers hold the index lock
+
+        every role directory is scanned once. when anything changed, a
+        collection of the next generation is written: chunks of unchanged
+        documents are copied over with their embeddings, changed files are
+        parsed and split in a process pool and their chunks are streamed into
+        embedding batches as they're ready. the manifest is updated with the
+        new file fingerprints and collection, the served collection isn't
+        touched
+        """
+        if manifest is None:
+            manifest = load_manifest(self.manifest_path)
+
+        # roles whose directory was deleted still need their chunks removed
+        roles = sorted(set(self.get_roles()) | set(manifest["files"]))
+
+        updated_files = {}
+        stale_ids = []
+        kept_ids = []
+        jobs = []
+
+        for role in roles:
+            data_path = os.path.join(self.data_path, role)
+            tracked = manifest["files"].get(role, {})
+
+            try:
+                fingerprints, changed, removed = diff_directory(
+                    data_path, tracked,
+                    tuple(ChatBot.document_extensions))
+            except Exception as e:
+                raise Exception(e.args)
+
+            stale_ids.extend(
+                chunk_id for file_name in changed + removed
+                for chunk_id in tracked.get(file_name, {}).get(
+                    "chunk_ids", []))
+
+            updated_files[role] = {}
+            for file_name, fingerprint in fingerprints.items():
+                if file_name in changed:
+                    updated_files[role][file_name] = {
+                        **fingerprint, "chunk_ids": []}
+                    jobs.append((role, os.path.join(data_path, file_name)))
+                else:
+                    updated_files[role][file_name] = {
+                        **fingerprint,
+                        "chunk_ids": tracked[file_name]["chunk_ids"]}
+                    kept_ids.extend(tracked[file_name]["chunk_ids"])
+
+        updated_files = {
+            role: files for role, files in updated_files.items() if files}
+        previous = manifest["collection"]
+
+        if previous is not None and not jobs and not stale_ids:
+            # only fingerprints (e.g. mtimes) may have changed
+            manifest["files"] = updated_files
+            save_manifest(manifest, self.manifest_path)
+            self.load_index_metadata(manifest)
+            return manifest
+
+        generation = manifest["generation"] + 1
+        collection_name = f"{self.collection_name}-v{generation}"
+
+        # drops leftovers of an interrupted build
+        self.prune_collections(previous)
+        vector_store = self.open_vector_store(collection_name)
+
+        bm25 = None
+        if previous is not None:
+            self.copy_chunks(
+                previous, collection_name, kept_ids, vector_store)
+
+            if self.hybrid_retrieval:
+                bm25 = self.load_bm25(previous).copy()
+                bm25.remove(stale_ids)
+        elif self.hybrid_retrieval:
+            bm25 = BM25Index()
+
+        self.files_to_index = len(jobs)
+        self.ingestion_stats = IngestionStats()
+
+        def chunk_stream():
+            """yields (chunk id, chunk) pairs as files finish splitting"""
+            for role, file_path, chunks in iter_chunks(
+                    jobs, self.chunk_size, self.chunk_overlap,
+                    max_workers=self.ingestion_workers):
+                file_name = os.path.basename(file_path)
+                chunk_ids = [
+                    f"{role}/{file_name}#{index}"
+                    for index in range(len(chunks))]
+
+                updated_files[role][file_name]["chunk_ids"] = chunk_ids
+                self.ingestion_stats.add(len(chunks))
+
+                yield from zip(chunk_ids, chunks)
 
-    def run(self):
-        """runs the indexing process: loading + splitting + chunking"""
-        # handle
         try:
-            student_documents = self.load_documents(self.student_data_path)
-            teacher_documents = self.load_documents(self.teacher_data_path)
+            for batch in batched(chunk_stream(), self.embedding_batch_size):
+                chunks = [chunk for _, chunk in batch]
+                chunk_ids = [chunk_id for chunk_id, _ in batch]
+
+                self.save_to_chroma(chunks, chunk_ids, vector_store)
+                if bm25 is not None:
+                    bm25.add(chunk_ids, chunks)
         except Exception as e:
             raise Exception(e.args)
+        finally:
+            self.ingestion_stats.stop()
+
+        if self.vector_backend == "numpy":
+            vector_store.save()
+        if bm25 is not None:
+            bm25.save(self.bm25_path(collection_name))
+
+        manifest["files"] = updated_files
+        manifest["collection"] = collection_name
+        manifest["generation"] = generation
+        manifest["backend"] = self.vector_backend
+        manifest["embedding_model"] = self.embedding_model
+        save_manifest(manifest, self.manifest_path)
+        self.load_index_metadata(manifest)
+
+        print(f"wrote collection {collection_name}, "
+              f"{len(kept_ids)} chunks copied")
+        if jobs:
+            stats = self.ingestion_stats.summary()
+            print(f"indexed {stats['files']} files "
+                  f"({stats['files_per_second']} files/s), "
+                  f"{stats['chunks']} chunks "
+                  f"({stats['chunks_per_second']} chunks/s)")
+
+        return manifest
+
+    async def acanonical_entry(self, role: str, file_name: str,
+                               content_hash: str) -> dict:
+        """generates the canonical question, paraphrases and answer of an
+        FAQ article"""
+        question = canonical_question(file_name)
+        documents = await asyncio.to_thread(
+            self.load_document, os.path.join(self.data_path, role, file_name))
+        article = "\n\n".join(document.page_content for document in documents)
+        # the article is capped like the retrieved context
+        article = article[:self.context_token_budget * 4]
+
+        config = {"configurable": {"role": role}}
+        paraphrases: Paraphrases = await self.allm(
+            self.paraphrase_llm,
+            self.paraphrasing_template.invoke({
+                "count": self.paraphrase_count, "role": role,
+                "question": question}),
+            config, name="canonical")
+        answer = await self.allm(
+            self.llm,
+            self.canonical_answering_template.invoke({
+                "role": role, "article": article, "question": question}),
+            config, name="canonical")
+
+        return {
+            "role": role,
+            "file_name": file_name,
+            "hash": content_hash,
+            "question": question,
+            "paraphrases": [
+                paraphrase.strip() for paraphrase in paraphrases.questions
+                if paraphrase.strip()][:self.paraphrase_count],
+            "answer": answer.content
+        }
+
+    async def aprecompute_answers(self, manifest: dict):
+        """brings the canonical answers up to date with the indexed articles,
+        only added or changed articles are sent to the llm
+
+        a single worker generates them, the others wait for it (without
+        holding the index lock) and then only load them. articles are
+        generated one at a time through the llm limiter, so requests keep
+        the other slots. an article that fails (e.g. when the llm queue is
+        full) is retried on the next reindex
+        """
+        while True:
+            with index_lock(f"{self.canonical_answers_path}.lock",
+                            blocking=False) as acquired:
+                if acquired:
+                    await self.aupdate_answers(manifest)
+                    return
+
+            await asyncio.sleep(1)
+
+    async def aupdate_answers(self, manifest: dict):
+        """generates the missing canonical answers and serves them, callers
+        hold the answers' lock"""
+        answers = await asyncio.to_thread(
+            CanonicalAnswers.load, self.canonical_answers_path)
+        articles = {
+            f"{role}/{file_name}": (role, file_name, fingerprint["hash"])
+            for role, files in manifest["files"].items()
+            for file_name, fingerprint in files.items()}
+
+        for key in [key for key in answers.entries if key not in articles]:
+            del answers.entries[key]
+
+        generated = 0
+        for key, (role, file_name, content_hash) in articles.items():
+            if answers.entries.get(key, {}).get("hash") == content_hash:
+                continue
+
+            try:
+                answers.entries[key] = await self.acanonical_entry(
+                    role, file_name, content_hash)
+                generated += 1
+            except Exception as e:
+                answers.entries.pop(key, None)
+                print(f"Canonical answer of {key} failed: {e}")
+
+        await asyncio.to_thread(answers.save)
+
+        rows = answers.questions()
+        answers.set_vectors(
+            [key for key, _ in rows],
+            await self.initialize_embedding().aembed_documents(
+                [text for _, text in rows]))
+        self.canonical_answers = answers
+
+        if generated:
+            print(f"generated {generated} canonical answers")
+
+    def load_index_metadata(self, manifest: dict):
+        """updates what's derived from the indexed files"""
+        # file names are the questions each article answers
+        self.kb_topics = [
+            os.path.splitext(file_name)[0].replace("-", " ")
+            for files in manifest["files"].values() for file_name in files]
+        self.router_centroids = None
+
+        # cached answers may be outdated once the knowledge base changes
+        self.kb_version = manifest_digest(manifest)
+        if self.response_cache is not None:
+            self.response_cache.set_version(self.kb_version)
+
+    async def cache_node(self, state: BotState, config):
+        """serves first-turn questions from the semantic response cache
+
+        multi-turn answers depend on the conversation so only the first
+        question of a session is looked up (and later cached)
+        """
+        if len(state["messages"]) != 1:
+            return {"route": None, "question": None}
+
+        role = config.get("configurable", {}).get("role", None)
+        question = (state["messages"][-1]).content
+
+        response = self.response_cache.lookup(
+            role, await self.initialize_embedding().aembed_query(question))
+
+        if response is None:
+            return {"route": None, "question": question}
+
+        return {"messages": AIMessage(content=response), "route": "end",
+                "question": None}
 
-        # keeps track of all chunked documents
-        loaded_student_documents = [
-            os.path.basename(
-                doc.metadata["source"]) for doc in student_documents]
+    async def canonical_node(self, state: BotState, config):
+        """answers first-turn questions matching an FAQ article with the
+        article's precomputed answer, which joins the session history like
+        a generated one
 
-        loaded_teacher_documents = [
-            os.path.basename(
-                doc.metadata["source"]) for doc in teacher_documents]
+        later turns depend on the conversation so they're always generated
+        """
+        answers = self.canonical_answers
+        if answers is None or len(state["messages"]) != 1:
+            return {"route": None}
+
+        role = config.get("configurable", {}).get("role", None)
+        question = (state["messages"][-1]).content
+
+        entry = answers.match(
+            await self.initialize_embedding().aembed_query(question), role,
+            self.canonical_threshold, self.canonical_margin)
+
+        if entry is None:
+            return {"route": None}
+
+        return {"messages": AIMessage(content=entry["answer"]),
+                "route": "end"}
+
+    async def aembedding_route(self, question: str):
+        """classifies a query against the small talk ("answer") and knowledge
+        base ("rag") centroids
+
+        returns the route and its similarity margin, the route is None when
+        the margin is too low to decide without the llm
+        """
+        embedding = self.initialize_embedding()
+
+        if self.router_centroids is None:
+            examples = {
+                "answer": ChatBot.small_talk_examples,
+                "rag": self.kb_topics
+            }
+            centroids = {}
+            for route, texts in examples.items():
+                if not texts:
+                    return None, None
+
+                vectors = np.asarray(
+                    await embedding.aembed_documents(texts), dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                centroid = vectors.mean(axis=0)
+                centroids[route] = centroid / np.linalg.norm(centroid)
+
+            self.router_centroids = centroids
+
+        query = np.asarray(
+            await embedding.aembed_query(question), dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        similarities = {
+            route: float(centroid @ query)
+            for route, centroid in self.router_centroids.items()}
+        route = max(similarities, key=similarities.get)
+        margin = abs(similarities["rag"] - similarities["answer"])
+
+        if margin < self.router_margin:
+            return None, margin
+
+        return route, margin
+
+    async def allm(self, llm, llm_input, config=None, name: str = "answer"):
+        """invokes one of the chatbot's llms once a concurrency slot is free
+
+        raises QueueFullError or QueueTimeoutError when the llm is
+        overloaded, an optional "deadline" (time.monotonic()) in
+        config["configurable"] bounds the wait. the call's latency and
+        tokens are recorded under `name`
+        """
+        deadline, role = None, None
+        if config is not None:
+            deadline = config.get("configurable", {}).get("deadline", None)
+            role = config.get("configurable", {}).get("role", None)
+
+        started = time.perf_counter()
+        async with self.llm_limiter.slot(deadline):
+            admitted = time.perf_counter()
+            response = await llm.ainvoke(llm_input)
+        finished = time.perf_counter()
+
+        llm_queue_seconds.observe(admitted - started, name)
+        llm_seconds.observe(finished - admitted, name, role)
+        add_timing(f"llm-{name}", finished - started)
+
+        raw = response
+        if isinstance(response, dict) and "raw" in response:
+            # structured output
+            if response["parsing_error"] is not None:
+                raise response["parsing_error"]
+            raw, response = response["raw"], response["parsed"]
+
+        usage = getattr(raw, "usage_metadata", None)
+        if usage:
+            prompt_tokens.observe(usage["input_tokens"], name, role)
+            completion_tokens.observe(usage["output_tokens"], name, role)
+
+        return response
+
+    async def awarmup(self):
+        """loads both models into ollama and runs a dummy embedding, route
+        and answer so the first real request doesn't pay for cold starts
+
+        the embedding goes straight to the model since a cached vector
+        wouldn't load it
+        """
+        question = "hello, what can you do?"
 
-        # save loaded documents to a json file
-        save_to_json(data_to_save=list(set(loaded_student_documents)),
-                     file_path="./tracked_student.json")
-        save_to_json(data_to_save=list(set(loaded_teacher_documents)),
-                     file_path="./tracked_teacher.json")
+        await self.initialize_embedding().embeddings.aembed_query(question)
 
-        student_chunks = (self.initialize_text_splitter()).split_documents(
-            student_documents
-        )
-        teacher_chunks = (self.initialize_text_splitter()).split_documents(
-            teacher_documents
-        )
+        if self.router_mode == "embedding":
+            # also builds the route centroids
+            await self.aembedding_route(question)
 
-        return (student_chunks, teacher_chunks)
+        await self.allm(
+            self.router_llm,
+            self.routing_template.invoke({"question": question}),
+            name="warmup")
+        # a single token is enough to load the model
+        await self.allm(
+            self.answer_llm.bind(options={"num_predict": 1}),
+            [{"role": "user", "content": question}], name="warmup")
 
-    async def router_node(self, state: BotState):
+        self.warmed_up = True
+
+    async def router_node(self, state: BotState, config):
         """core router node responsible for properly forwarding queries
         along the right workflow branch
         """
+        if self.router_mode == "embedding":
+            route, margin = await self.aembedding_route(
+                (state["messages"][-1]).content)
+
+            if route is not None:
+                return {"route": route, "route_confidence": margin}
+
         if len(state["messages"]) == 0:
             # Initial state: start of the conversation
 
             route_prompt = self.routing_template.invoke(
                 {"question": (state["messages"]).content})
-            route_decision: RouteDecision = await self.router_llm.ainvoke(
-                route_prompt)
+            route_decision: RouteDecision = await self.allm(
+                self.router_llm, route_prompt, config, "router")
         else:
             # Subsequent state: other conversations
 
             route_prompt = self.routing_template.invoke(
                 {"question": (state["messages"][-1]).content})
-            route_decision: RouteDecision = await self.router_llm.ainvoke(
-                route_prompt)
+            route_decision: RouteDecision = await self.allm(
+                self.router_llm, route_prompt, config, "router")
 
-        return {"route": route_decision.route}
+        return {"route": route_decision.route, "route_confidence": None}
 
     async def aretrieve(self, state: BotState, config):
         """query the vector store asynchronously
         to retrieved context based on user role"""
         role = config.get("configurable", {}).get("role", None)
 
-        if role == "student":
-            vector_store = self.student_vector_store
-        elif role == "teacher":
-            vector_store = self.teacher_vector_store
-        else:
-            vector_store = self.vector_store
+        if self.vector_store is None:
+            # the first index is still being built
+            return {"context": [], "relevance": []}
+
+        if (prefetched := config.get("configurable", {}).get(
+                "retrieval")) is not None:
+            # retrieved ahead of time with the rest of a batch
+            retrieved_docs, relevance = prefetched
+            return {"context": retrieved_docs, "relevance": relevance}
 
         if len(state["messages"]) == 0:
             # Initial state: start of the conversation
 
-            retrieved_docs = await vector_store.asimilarity_search(
-                (state["messages"]).content)
-            return {"context": retrieved_docs}
+            retrieved_docs, relevance = await self.asearch(
+                (state["messages"]).content, role)
+            return {"context": retrieved_docs, "relevance": relevance}
         else:
             # Subsequent state: other conversations
 
-            retrieved_docs = await vector_store.asimilarity_search(
-                (state["messages"][-1]).content)
-            return {"context": retrieved_docs}
+            retrieved_docs, relevance = await self.asearch(
+                (state["messages"][-1]).content, role)
+            return {"context": retrieved_docs, "relevance": relevance}
+
+    def score_retrieval(self, relevance: Optional[list[float]]
+                        ) -> Optional[bool]:
+        """decides from the vector relevance scores whether a retrieval is
+        sufficient, None when the top score falls in the ambiguous band
+
+        a top score at or above the threshold is sufficient, so is one in
+        the band that leads the runner-up by the margin
+        """
+        if not relevance:
+            return False
+
+        top = relevance[0]
+        margin = top - relevance[1] if len(relevance) > 1 else top
+
+        if top >= self.relevance_threshold:
+            return True
+        if top < self.relevance_threshold - self.judge_band:
+            return False
+        if margin >= self.relevance_margin:
+            return True
+
+        return None
+
+    async def ajudge_retrieval(self, question: str, context: list[Document],
+                               relevance: Optional[list[float]],
+                               config) -> bool:
+        """whether a retrieval is sufficient, the judge llm is only asked
+        about ambiguous scores"""
+        if relevance is None and context:
+            # a lexical fast path match already cleared the BM25 score floor
+            # and margin, weaker matches went through the vector search
+            self.gate_stats["scored"] += 1
+            return True
+
+        sufficient = self.score_retrieval(relevance)
+        if sufficient is not None:
+            self.gate_stats["scored"] += 1
+            return sufficient
+
+        self.gate_stats["judged"] += 1
+        judge_prompt = self.retrieval_judging_template.invoke({
+            "question": question,
+            "context": build_context(
+                context, self.context_token_budget,
+                count_tokens=estimate_tokens)})
+        judgement: RagJudge = await self.allm(
+            self.judge_llm, judge_prompt, config, "judge")
+
+        return judgement.sufficient
+
+    async def gate_node(self, state: BotState, config):
+        """sufficiency gate between retrieval and the rag prompt
+
+        an insufficient retrieval is widened once (more chunks, every role)
+        before its context is dropped and the question answered directly
+        """
+        if self.speculative_retrieval and state.get("context") is not None:
+            # context was prefetched while routing
+            retrieval = {"context": state["context"],
+                         "relevance": state.get("relevance")}
+        else:
+            retrieval = await self.aretrieve(state, config)
+
+        question = (state["messages"][-1]).content
+
+        if await self.ajudge_retrieval(
+                question, retrieval["context"], retrieval["relevance"],
+                config):
+            return retrieval
+
+        if self.vector_store is not None:
+            self.gate_stats["widened"] += 1
+            context, relevance = await self.asearch(
+                question, None, scale=2)
+
+            if await self.ajudge_retrieval(
+                    question, context, relevance, config):
+                return {"context": context, "relevance": relevance}
+
+        self.gate_stats["dropped"] += 1
+        return {"context": None, "relevance": None, "route": "answer"}
+
+    def from_gate(self, state: BotState) -> Literal["rag", "answer"]:
+        """skips the rag prompt when the context was dropped"""
+        if state.get("context"):
+            return "rag"
+
+        return "answer"
+
+    async def asearch(self, query: str, role: Optional[str] = None,
+                      scale: int = 1):
+        """returns the chunks of a role (or of every role) best matching a
+        query, combining the vector store and BM25 index, and the relevance
+        scores of the vector hits
+
+        the scores are None when a decisive lexical match skipped the vector
+        search, scale multiplies the number of chunks fetched
+        """
+        return (await self.abatch_search([query], role, scale))[0]
+
+    async def abatch_search(self, queries: list[str],
+                            role: Optional[str] = None, scale: int = 1):
+        """searches several queries of one role, see asearch
+
+        the numpy backend embeds and searches the queries that need a vector
+        search in a single batch
+        """
+        started = time.perf_counter()
+        # other workers may have switched to (and pruned up to) a newer
+        # collection
+        serving = await asyncio.to_thread(self.refresh_index)
+
+        try:
+            results = await self.asearch_collection(
+                serving, queries, role, scale)
+        except Exception:
+            refreshed = await asyncio.to_thread(self.refresh_index, True)
+            if refreshed is serving:
+                raise
+            # the collection was deleted while it was searched
+            results = await self.asearch_collection(
+                refreshed, queries, role, scale)
+
+        seconds = time.perf_counter() - started
+        search_seconds.observe(seconds, role)
+        add_timing("search", seconds)
+
+        return [results[query] for query in queries]
+
+    async def asearch_collection(self, serving: tuple, queries: list[str],
+                                 role: Optional[str], scale: int) -> dict:
+        """searches the served (collection, vector store, BM25 index), the
+        tuple is read once so a concurrent reindex can't mix generations"""
+        _, vector_store, bm25 = serving
+
+        # a missing role searches every role's chunks
+        search_filter = {"role": role} if role is not None else None
+
+        results = {}
+        lexical_hits = {}
+        pending = []
+
+        for query in dict.fromkeys(queries):
+            if bm25 is not None:
+                lexical_hits[query] = bm25.search(
+                    query, k=self.bm25_k * scale, role=role)
+
+                if is_decisive(lexical_hits[query], self.lexical_fast_path,
+                               self.lexical_min_score):
+                    # exact terms settle it, the query isn't embedded
+                    results[query] = [
+                        document for document, _ in lexical_hits[query]][
+                        :self.context_k * scale], None
+                    continue
+
+            pending.append(query)
+
+        if len(pending) > 1 and isinstance(vector_store, NumpyVectorStore):
+            vector_hits = await vector_store.abatch_similarity_search(
+                pending, k=self.vector_k * scale, filter=search_filter)
+        else:
+            vector_hits = await asyncio.gather(*(
+                vector_store.asimilarity_search_with_relevance_scores(
+                    query, k=self.vector_k * scale, filter=search_filter)
+                for query in pending))
+
+        for query, hits in zip(pending, vector_hits):
+            relevance = [score for _, score in hits]
+
+            if bm25 is None:
+                results[query] = [document for document, _ in hits], relevance
+            else:
+                results[query] = reciprocal_rank_fusion(
+                    [[document for document, _ in hits],
+                     [document for document, _ in lexical_hits[query]]],
+                    k=self.rrf_k, limit=self.context_k * scale), relevance
+
+        return results
+
+    async def asource_texts(self, documents: list[Document]) -> dict:
+        """returns the whole text of the sources of documents that may fit
+        the context budget, cached per knowledge base version"""
+        texts = {}
+
+        for source in {document.metadata.get("source")
+                       for document in documents}:
+            key = (self.kb_version, source)
+
+            if key not in self.source_texts:
+                try:
+                    # files are never smaller than their text
+                    if os.path.getsize(source) > (
+                            self.context_token_budget * 8):
+                        continue
+                    pages = await asyncio.to_thread(load_file, source)
+                except Exception:
+                    continue
+
+                self.source_texts[key] = "\n\n".join(
+                    page.page_content for page in pages)
+                while len(self.source_texts) > 256:
+                    self.source_texts.popitem(last=False)
+
+            self.source_texts.move_to_end(key)
+            texts[source] = self.source_texts[key]
+
+        return texts
 
     async def agenerate(self, state: BotState, config):
         """reconstructs the query based on retrieved context"""
-        context = await self.aretrieve(state, config)
+        if (self.speculative_retrieval or self.retrieval_gate) and (
+                state.get("context") is not None):
+            # context was prefetched while routing or passed by the gate
+            context = {"context": state["context"]}
+        else:
+            context = await self.aretrieve(state, config)
 
-        docs_content = "\n\n".join(
-            doc.page_content for doc in context["context"])
+        docs_content = build_context(
+            context["context"], self.context_token_budget,
+            await self.asource_texts(context["context"]), estimate_tokens)
 
         modified_query = self.querying_template.invoke(
                 {"question": (state["messages"][-1]).content,
@@ -328,7 +1464,7 @@ class ChatBot():
         state["messages"].append(
             modified_query.messages[0])
         # print(state["messages"])
-        return {"messages": state["messages"]}
+        return {"messages": state["messages"], "context": context["context"]}
 
     async def answer_node(self, state: BotState, config):
         """llm node for answering all queries."""
@@ -359,38 +1495,321 @@ class ChatBot():
             - Make your responses as short as possible.
             """
         }
-        # prepend EduBot's identity
-        messages_with_identity = [system_message] + state["messages"]
+        thread_id = config.get("configurable", {}).get("thread_id", None)
+        summary = state.get("summary")
+        update = {}
+
+        carried = []
+        if (pending := self.summary_tasks.pop(thread_id, None)) is not None:
+            task, summarized = pending
+            if not task.done():
+                # the answer doesn't wait for the summary, the messages it
+                # folds in are sent verbatim until a later turn picks it up
+                self.summary_tasks[thread_id] = pending
+                carried = summarized
+            elif not task.cancelled() and task.exception() is None:
+                # the previous turn's summary may not be in this turn's state
+                summary = task.result()
+                update["summary"] = summary
+
+        if carried:
+            # nothing more is trimmed while a summary is in flight
+            recent, trimmed = carried + state["messages"], []
+        else:
+            recent, trimmed = self.window_messages(state["messages"])
+
+        # prepend EduBot's identity and what's left of older turns
+        messages_with_identity = [system_message]
+        if summary:
+            messages_with_identity.append(SystemMessage(
+                content=f"Summary of the earlier conversation: {summary}"))
+        messages_with_identity.extend(recent)
+
+        response = await self.allm(
+            self.answer_llm, messages_with_identity, config)
+        update["messages"] = response
+
+        if trimmed and thread_id is not None and self.graph is not None:
+            # the checkpoint keeps the trimmed history, the summary is
+            # written off the critical path
+            update["messages"] = [
+                RemoveMessage(id=message.id) for message in trimmed
+                ] + [response]
+            self.schedule_summary(config, summary, trimmed)
+
+        if state.get("route") == "answer" and state.get("context"):
+            # discard context prefetched for a turn that didn't need it
+            update["context"] = None
+
+        if self.response_cache is not None and state.get("question"):
+            self.response_cache.store(
+                config.get("configurable", {}).get("role", None),
+                await self.initialize_embedding().aembed_query(
+                    state["question"]),
+                response.content)
+
+        return update
+
+    def window_messages(self, messages: list[BaseMessage]):
+        """splits the history into the most recent messages that fit the
+        token budget and the older messages to be summarized
+
+        the latest message is always kept and the window never starts with
+        an answer cut off from its question
+        """
+        if not self.history_token_budget:
+            return messages, []
+
+        start = len(messages) - 1
+        used = estimate_tokens(str(messages[start].content))
+
+        while start > 0:
+            tokens = estimate_tokens(str(messages[start - 1].content))
+            if used + tokens > self.history_token_budget:
+                break
+            used += tokens
+            start -= 1
+
+        while start < len(messages) - 1 and isinstance(
+                messages[start], AIMessage):
+            start += 1
+
+        return messages[start:], messages[:start]
+
+    async def asummarize(self, summary: Optional[str],
+                         messages: list[BaseMessage]) -> str:
+        """folds messages into the rolling conversation summary"""
+        conversation = "\n".join(
+            f"{message.type}: {message.content}" for message in messages)
+
+        summary_prompt = self.summarizing_template.invoke(
+            {"summary": summary or "none", "conversation": conversation})
+        response = await self.allm(self.llm, summary_prompt, name="summary")
+
+        return response.content
+
+    def schedule_summary(self, config, summary: Optional[str],
+                         messages: list[BaseMessage]) -> None:
+        """updates a thread's summary in the background
+
+        the result is saved to the thread's checkpoint and kept until the
+        thread's next turn picks it up, since that turn may have loaded its
+        state before the summary was saved
+        """
+        thread_id = config["configurable"]["thread_id"]
+        thread_config = {"configurable": {"thread_id": thread_id}}
 
-        response = await self.answer_llm.ainvoke(messages_with_identity)
-        return {"messages": response}
+        async def update_summary():
+            new_summary = await self.asummarize(summary, messages)
+            await self.graph.aupdate_state(
+                thread_config, {"summary": new_summary}, as_node="answer")
+            return new_summary
+
+        # summaries of expired sessions will never be picked up
+        for expired_id in [
+                task_thread_id for task_thread_id, (task, _)
+                in self.summary_tasks.items()
+                if task.done() and not self.memory.has_session(
+                    task_thread_id)]:
+            del self.summary_tasks[expired_id]
+
+        task = asyncio.create_task(update_summary())
+        self.summary_tasks[thread_id] = (task, messages)
+
+        def retrieve_exception(done_task):
+            if not done_task.cancelled():
+                # a failed summary keeps the previous one
+                done_task.exception()
+
+        task.add_done_callback(retrieve_exception)
+
+    def from_canonical(self, state: BotState) -> list[str]:
+        """ends the workflow on a canonical answer"""
+        if state["route"] == "end":
+            return ["end"]
+
+        if self.response_cache is not None:
+            return ["cache"]
+
+        return self.entry_nodes()
+
+    def from_cache(self, state: BotState) -> list[str]:
+        """ends the workflow on a cache hit"""
+        if state["route"] == "end":
+            return ["end"]
+
+        return self.entry_nodes()
+
+    def entry_nodes(self) -> list[str]:
+        """returns the nodes that start a (non cached) turn"""
+        if self.speculative_retrieval:
+            return ["router", "prefetch"]
+
+        return ["router"]
 
     def from_router(self, state: BotState) -> Literal["rag", "answer"]:
         """returns route to follow down the graph"""
+        if state["route"] == "rag" and self.vector_store is None:
+            # nothing to retrieve from until the first index is built
+            return "answer"
+
         return state["route"]
 
-    def acompile(self):
-        """returns a grpah depicting the overall workflow"""
+    def instrument(self, name: str, node):
+        """wraps a graph node to record its latency, the routing decisions
+        and the chunks in the context of answers"""
+        async def timed_node(state: BotState, config):
+            started = time.perf_counter()
+            update = await node(state, config)
+            seconds = time.perf_counter() - started
+
+            role = config.get("configurable", {}).get("role", None)
+            route = (update or {}).get("route") or state.get("route")
+            node_seconds.observe(seconds, name, role, route)
+            add_timing(name, seconds)
+
+            if name == "router":
+                routes.inc(update["route"], role, "embedding" if update.get(
+                    "route_confidence") is not None else "llm")
+            elif name in ("canonical", "cache") and (
+                    update.get("route") == "end"):
+                routes.inc(name, role, name)
+            elif name == "answer":
+                retrieved_chunks.observe(
+                    len(state.get("context") or []), role, route)
+
+            return update
+
+        return timed_node
+
+    def acompile(self, stateless: bool = False):
+        """returns a grpah depicting the overall workflow
+
+        a stateless graph has no checkpointer, every invocation is a single
+        turn conversation
+        """
         graph_builder = StateGraph(BotState)
 
         # adding graph nodes
-        graph_builder.add_node("router", self.router_node)
-        graph_builder.add_node("answer", self.answer_node)
-        graph_builder.add_node("rag", self.agenerate)
-
-        # setting graph's entry point as the router
-        graph_builder.set_entry_point("router")
+        graph_builder.add_node(
+            "router", self.instrument("router", self.router_node))
+        graph_builder.add_node(
+            "answer", self.instrument("answer", self.answer_node))
+        graph_builder.add_node(
+            "rag", self.instrument("rag", self.agenerate))
+
+        if self.retrieval_gate:
+            # retrieval is checked before it's put in the rag prompt
+            graph_builder.add_node(
+                "gate", self.instrument("gate", self.gate_node))
+            graph_builder.add_conditional_edges(
+                "gate", self.from_gate, {"rag": "rag", "answer": "answer"})
+
+        if self.speculative_retrieval:
+            # retrieval runs alongside the router, its context is consumed
+            # by the "rag" branch
+            graph_builder.add_node(
+                "prefetch", self.instrument("prefetch", self.aretrieve))
+            graph_builder.add_edge("prefetch", END)
+
+        if self.response_cache is not None:
+            # cache lookups come before routing
+            graph_builder.add_node(
+                "cache", self.instrument("cache", self.cache_node))
+            graph_builder.add_conditional_edges(
+                "cache", self.from_cache,
+                {**{node: node for node in self.entry_nodes()}, "end": END})
+
+        if self.canonical_answers_enabled:
+            # canonical answers are looked up first, before the cache
+            graph_builder.add_node(
+                "canonical", self.instrument(
+                    "canonical", self.canonical_node))
+            graph_builder.set_entry_point("canonical")
+
+            next_nodes = {node: node for node in self.entry_nodes()}
+            if self.response_cache is not None:
+                next_nodes["cache"] = "cache"
+            graph_builder.add_conditional_edges(
+                "canonical", self.from_canonical, {**next_nodes, "end": END})
+        elif self.response_cache is not None:
+            graph_builder.set_entry_point("cache")
+        else:
+            # setting graph's entry point as the router
+            for node in self.entry_nodes():
+                graph_builder.add_edge(START, node)
 
         # adding graph edges
+        rag_entry = "gate" if self.retrieval_gate else "rag"
         graph_builder.add_conditional_edges("router", self.from_router,
                                             {
-                                                "rag": "rag",
+                                                "rag": rag_entry,
                                                 "answer": "answer"
                                             })
         graph_builder.add_edge("rag", "answer")
         graph_builder.add_edge("answer", END)
 
         # compile the graph with an in-memory saver
+        if stateless:
+            return graph_builder.compile()
+
         graph = graph_builder.compile(checkpointer=self.memory)
 
+        # background summaries are written back through the graph
+        self.graph = graph
+
         return graph
+
+    async def abatch(self, items: list[dict], max_concurrency: int = 4,
+                     deadline: Optional[float] = None):
+        """answers many single turn prompts, yielding (indexes, result) as
+        they complete
+
+        items are {"prompt", "role"} dicts. identical prompts of a role are
+        answered once (indexes lists every item they answer), all prompts are
+        embedded in batched calls and retrieved per role in one batch before
+        at most max_concurrency graph runs start. a result is the response
+        text or the exception that failed it
+        """
+        if self.batch_graph is None:
+            self.batch_graph = self.acompile(stateless=True)
+
+        unique = {}
+        for index, item in enumerate(items):
+            unique.setdefault(
+                (" ".join(item["prompt"].split()), item.get("role")),
+                []).append(index)
+
+        prompts = list(dict.fromkeys(prompt for prompt, _ in unique))
+        await self.initialize_embedding().aembed_queries(prompts)
+
+        retrievals = {}
+        if self.vector_store is not None:
+            for role in {role for _, role in unique}:
+                role_prompts = [
+                    prompt for prompt, prompt_role in unique
+                    if prompt_role == role]
+                for prompt, retrieval in zip(role_prompts, (
+                        await self.abatch_search(role_prompts, role))):
+                    retrievals[(prompt, role)] = retrieval
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(key):
+            prompt, role = key
+            config = {"configurable": {
+                "role": role,
+                "deadline": deadline,
+                "retrieval": retrievals.get(key)
+                }}
+
+            async with semaphore:
+                try:
+                    response = await self.batch_graph.ainvoke(
+                        {"messages": prompt}, config)
+                    return unique[key], response["messages"][-1].content
+                except Exception as e:
+                    return unique[key], e
+
+        for task in asyncio.as_completed([answer(key) for key in unique]):
+            yield await task
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from metrics import embedding_seconds, timed
+
+
+def normalize_text(text: str) -> str:
+    """collapses whitespace so formatting-only differences share a key"""
+    return " ".join(text.split())
+
+
+def text_key(text: str) -> str:
+    """returns the content address of a text"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """content-addressed embedding cache wrapped around an embedding model
+
+    vectors are keyed by (model name, normalized text hash) and persisted in
+    sqlite as float32 blobs, only cache misses are sent to the wrapped model
+    (in batches), queries are additionally served from an in-process LRU.
+    the async methods run the sqlite reads and writes in worker threads
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str,
+                 cache_path: str = "./embedding_cache.sqlite",
+                 batch_size: int = 64,
+                 query_cache_size: int = 1024):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.query_cache_size = query_cache_size
+
+        self.query_cache: OrderedDict[str, list[float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        # chroma embeds queries from executor threads
+        self.connection = sqlite3.connect(
+            cache_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, key)
+            )""")
+        self.connection.commit()
+
+    def _load(self, keys: list[str]) -> dict[str, list[float]]:
+        """returns the persisted vectors of the given keys"""
+        found = {}
+
+        with self.lock:
+            # stays below sqlite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection.execute(
+                    "SELECT key, vector FROM embeddings WHERE model = ? "
+                    f"AND key IN ({', '.join('?' * len(batch))})",
+                    [self.model, *batch]).fetchall()
+
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+        return found
+
+    def _save(self, vectors: dict[str, list[float]]) -> None:
+        """persists vectors under their keys"""
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, vector) "
+                "VALUES (?, ?, ?)",
+                [(self.model, key, array("f", vector).tobytes())
+                 for key, vector in vectors.items()])
+            self.connection.commit()
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        """adds a query vector to the LRU"""
+        with self.lock:
+            self.query_cache[key] = vector
+            self.query_cache.move_to_end(key)
+
+            while len(self.query_cache) > self.query_cache_size:
+                self.query_cache.popitem(last=False)
+
+    def _recall(self, key: str) -> list[float] | None:
+        """returns a query vector from the LRU"""
+        with self.lock:
+            vector = self.query_cache.get(key)
+            if vector is not None:
+                self.query_cache.move_to_end(key)
+
+        return vector
+
+    def _misses(self, texts: list[str]) -> tuple[
+            list[str], dict[str, list[float]], dict[str, str]]:
+        """returns the keys of texts, the cached vectors and the unique
+        texts that still have to be embedded"""
+        keys = [text_key(text) for text in texts]
+        found = self._load(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        return keys, found, missing
+
+    def _batches(self, missing: dict[str, str]):
+        """yields (keys, texts) batches of cache misses"""
+        items = list(missing.items())
+
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            yield [key for key, _ in batch], [text for _, text in batch]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """embeds texts, only sending cache misses to the model"""
+        keys, found, missing = self._misses(texts)
+
+        for batch_keys, batch_texts in self._batches(missing):
+            with timed(embedding_seconds, "documents", timing="embedding"):
+                vectors = dict(zip(
+                    batch_keys, self.embeddings.embed_documents(batch_texts)))
+            self._save(vectors)
+            found.update(vectors)
+
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """embeds texts asynchronously, only sending cache misses
+        to the model"""
+        keys, found, missing = await asyncio.to_thread(
+            self._misses, texts)
+
+        for batch_keys, batch_texts in self._batches(missing):
+            with timed(embedding_seconds, "documents", timing="embedding"):
+                vectors = dict(zip(
+                    batch_keys,
+                    await self.embeddings.aembed_documents(batch_texts)))
+            await asyncio.to_thread(self._save, vectors)
+            found.update(vectors)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        """embeds a query, served from the LRU or the persisted cache
+        when possible"""
+        key = text_key(text)
+
+        if (vector := self._recall(key)) is not None:
+            return vector
+
+        vector = self._load([key]).get(key)
+        if vector is None:
+            with timed(embedding_seconds, "query", timing="embedding"):
+                vector = self.embeddings.embed_query(text)
+            self._save({key: vector})
+
+        self._remember(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """embeds a query asynchronously, served from the LRU or the
+        persisted cache when possible"""
+        key = text_key(text)
+
+        if (vector := self._recall(key)) is not None:
+            return vector
+
+        vector = (await asyncio.to_thread(self._load, [key])).get(key)
+        if vector is None:
+            with timed(embedding_seconds, "query", timing="embedding"):
+                vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._save, {key: vector})
+
+        self._remember(key, vector)
+        return vector
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """embeds many queries with batched model calls, they're remembered
+        in the LRU for the single query lookups that follow"""
+        vectors = await self.aembed_documents(texts)
+
+        for text, vector in zip(texts, vectors):
+            self._remember(text_key(text), vector)
+
+        return vectors
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, Iterator, Optional
+
+from langchain_community.document_loaders import (
+    TextLoader, PyMuPDFLoader, CSVLoader)
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
+
+
+# supported knowledge source formats
+document_loaders = {
+    ".pdf": PyMuPDFLoader,
+    ".md": TextLoader,
+    ".txt": TextLoader,
+    ".csv": CSVLoader
+    }
+
+
+class IngestionStats():
+    """keeps track of ingestion throughput"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.files = 0
+        self.chunks = 0
+
+    def add(self, chunks: int) -> None:
+        self.files += 1
+        self.chunks += chunks
+
+    def stop(self) -> None:
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def summary(self) -> dict:
+        """returns files and chunks per second since ingestion started"""
+        elapsed = max(self.elapsed, 1e-9)
+        return {
+            "files": self.files,
+            "chunks": self.chunks,
+            "seconds": round(elapsed, 3),
+            "files_per_second": round(self.files / elapsed, 2),
+            "chunks_per_second": round(self.chunks / elapsed, 2)
+        }
+
+
+def load_file(file_path: str) -> list[Document]:
+    """loads a single knowledge source into a list of 'Document' objects"""
+    extension = os.path.splitext(file_path)[1]
+    loader_class = document_loaders[extension]
+
+    if extension == ".pdf":
+        loader = loader_class(file_path)
+    else:
+        loader = loader_class(file_path, encoding="utf-8")
+
+    return loader.load()
+
+
+def text_splitter(chunk_size: int,
+                  chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    """returns the splitter chunking every knowledge source, chunks record
+    their offset in the source"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        add_start_index=True
+    )
+
+
+def load_and_split(file_path: str, role: str, chunk_size: int,
+                   chunk_overlap: int) -> list[Document]:
+    """loads and chunks a single knowledge source, tagging every chunk with
+    its role
+
+    runs inside the worker processes so it has to stay picklable
+    """
+    chunks = text_splitter(chunk_size, chunk_overlap).split_documents(
+        load_file(file_path))
+    for chunk in chunks:
+        chunk.metadata["role"] = role
+
+    return chunks
+
+
+def iter_chunks(jobs: list[tuple[str, str]], chunk_size: int,
+                chunk_overlap: int, max_workers: Optional[int] = None
+                ) -> Iterator[tuple[str, str, list[Document]]]:
+    """yields (role, file path, chunks) for every (role, file path) job as
+    soon as it's parsed and split
+
+    files are spread over a process pool, a single worker (or a single job)
+    runs inline to skip the pool's start-up cost
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+
+    if max_workers <= 1:
+        for role, file_path in jobs:
+            yield role, file_path, load_and_split(
+                file_path, role, chunk_size, chunk_overlap)
+        return
+
+    # at most window files are in flight (parsing or parsed but not yet
+    # consumed) so memory is bounded whatever the corpus size
+    window = max_workers * 2
+    pending_jobs = iter(jobs)
+    futures = {}
+
+    # spawned workers, the caller is usually a thread of the server and
+    # forking a multi-threaded process can deadlock
+    with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn")) as executor:
+        while True:
+            for role, file_path in pending_jobs:
+                futures[executor.submit(
+                    load_and_split, file_path, role, chunk_size,
+                    chunk_overlap)] = (role, file_path)
+                if len(futures) >= window:
+                    break
+
+            if not futures:
+                return
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                role, file_path = futures.pop(future)
+                yield role, file_path, future.result()
+
+
+def batched(items: Iterable, batch_size: int) -> Iterator[list]:
+    """groups a stream of items into lists of at most batch_size items"""
+    batch = []
+
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
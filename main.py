@@ -1,13 +1,19 @@
 import asyncio
+import json
+import secrets
+import time
 from contextlib import asynccontextmanager
 import uuid
-from fastapi import FastAPI, HTTPException  # noqa
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, HTTPException  # noqa
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Literal, Optional
 from uuid import UUID  # noqa
 from datetime import datetime
 
 from chatbot import ChatBot
+from metrics import TimingMiddleware, registry, content_type
+from utils import env_setting, QueueFullError, QueueTimeoutError
 
 
 class PromptModel(BaseModel):
@@ -17,6 +23,24 @@ class PromptModel(BaseModel):
     prompt: str
 
 
+class StreamPromptModel(PromptModel):
+    # also stream router and retrieval frames
+    events: bool = False
+
+
+class BatchItemModel(BaseModel):
+    role: Optional[Literal["student", "teacher"]] = None
+    prompt: str
+
+
+class BatchPromptModel(BaseModel):
+    user_id: str
+    items: list[BatchItemModel]
+    # graph runs in flight, defaults to (and is capped at) the llm
+    # concurrency
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+
+
 class PromptResponseModel(BaseModel):
     user_id: str
     role: Optional[Literal["student", "teacher"]] = None
@@ -25,9 +49,82 @@ class PromptResponseModel(BaseModel):
     timestamp: datetime
 
 
+def create_bot() -> ChatBot:
+    """returns the chatbot configured from the environment, its index is
+    built separately"""
+    return ChatBot(
+        response_cache=env_setting("EDUBOT_RESPONSE_CACHE", False, bool),
+        response_cache_threshold=env_setting(
+            "EDUBOT_RESPONSE_CACHE_THRESHOLD", 0.95, float),
+        response_cache_ttl=env_setting(
+            "EDUBOT_RESPONSE_CACHE_TTL", 3600, int),
+        response_cache_size=env_setting(
+            "EDUBOT_RESPONSE_CACHE_SIZE", 1024, int),
+        router_mode=env_setting("EDUBOT_ROUTER_MODE", "llm"),
+        router_margin=env_setting("EDUBOT_ROUTER_MARGIN", 0.05, float),
+        speculative_retrieval=env_setting(
+            "EDUBOT_SPECULATIVE_RETRIEVAL", False, bool),
+        history_token_budget=env_setting(
+            "EDUBOT_HISTORY_TOKEN_BUDGET", 2000, int),
+        checkpointer=env_setting("EDUBOT_CHECKPOINTER", "memory"),
+        checkpoint_path=env_setting(
+            "EDUBOT_CHECKPOINT_PATH", "./sessions.sqlite"),
+        session_ttl=env_setting("EDUBOT_SESSION_TTL", 600, int),
+        max_sessions=env_setting("EDUBOT_MAX_SESSIONS", None, int),
+        max_session_bytes=env_setting(
+            "EDUBOT_MAX_SESSION_BYTES", None, int),
+        llm_concurrency=env_setting("EDUBOT_LLM_CONCURRENCY", 4, int),
+        llm_queue_size=env_setting("EDUBOT_LLM_QUEUE_SIZE", 32, int),
+        llm_queue_timeout=env_setting(
+            "EDUBOT_LLM_QUEUE_TIMEOUT", 30.0, float),
+        keep_alive=env_setting("EDUBOT_OLLAMA_KEEP_ALIVE", 1800, int),
+        ollama_pool_size=env_setting("EDUBOT_OLLAMA_POOL_SIZE", 16, int),
+        index_on_init=False,
+        reindex_debounce=env_setting("EDUBOT_REINDEX_DEBOUNCE", 2.0, float),
+        reindex_interval=env_setting(
+            "EDUBOT_REINDEX_INTERVAL", 30.0, float),
+        watch_interval=env_setting("EDUBOT_WATCH_INTERVAL", 0, float),
+        hybrid_retrieval=env_setting("EDUBOT_HYBRID_RETRIEVAL", True, bool),
+        vector_k=env_setting("EDUBOT_VECTOR_K", 4, int),
+        bm25_k=env_setting("EDUBOT_BM25_K", 4, int),
+        context_k=env_setting("EDUBOT_CONTEXT_K", 4, int),
+        rrf_k=env_setting("EDUBOT_RRF_K", 60, int),
+        lexical_fast_path=env_setting(
+            "EDUBOT_LEXICAL_FAST_PATH", 1.5, float),
+        lexical_min_score=env_setting(
+            "EDUBOT_LEXICAL_MIN_SCORE", 10.0, float),
+        vector_backend=env_setting("EDUBOT_VECTOR_BACKEND", "chroma"),
+        context_token_budget=env_setting(
+            "EDUBOT_CONTEXT_TOKEN_BUDGET", 1500, int),
+        retrieval_gate=env_setting("EDUBOT_RETRIEVAL_GATE", True, bool),
+        relevance_threshold=env_setting(
+            "EDUBOT_RELEVANCE_THRESHOLD", 0.5, float),
+        relevance_margin=env_setting("EDUBOT_RELEVANCE_MARGIN", 0.1, float),
+        judge_band=env_setting("EDUBOT_JUDGE_BAND", 0.15, float),
+        canonical_answers=env_setting(
+            "EDUBOT_CANONICAL_ANSWERS", False, bool),
+        canonical_answers_path=env_setting(
+            "EDUBOT_CANONICAL_ANSWERS_PATH", "./canonical_answers.json"),
+        canonical_threshold=env_setting(
+            "EDUBOT_CANONICAL_THRESHOLD", 0.9, float),
+        canonical_margin=env_setting("EDUBOT_CANONICAL_MARGIN", 0.05, float),
+        paraphrase_count=env_setting("EDUBOT_PARAPHRASES", 4, int),
+        )
+
+
+# chatbot instantiation happens in the background of the lifespan so the
+# port is bound right away, requests get a 503 until the bot is created.
+# indexing and the model warm-up run in the background too
+bot_init: Optional[ChatBot] = None
+bot = None
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # startup logic
+    # background tasks, cancelled on shutdown
+    tasks = []
+
     async def session_cleanup_logic():
         while True:
             try:
@@ -43,47 +140,126 @@ async def lifespan(app: FastAPI):
 
             await asyncio.sleep(300)  # runs every 10 minutes(1800)
 
-    cleanup_task = asyncio.create_task(session_cleanup_logic())
+    async def warmup_logic():
+        # retries until ollama is reachable, health checks fail until then
+        while not bot_init.warmed_up:
+            try:
+                await bot_init.awarmup()
+            except Exception as e:
+                print(f"Warm-up failed, retrying: {e}")
+                await asyncio.sleep(5)
+
+    async def indexing_logic():
+        # requests are served from the previous index (or without
+        # retrieval) meanwhile
+        try:
+            await bot_init.abuild_index()
+        except Exception as e:
+            print(f"Indexing failed: {e}")
+
+        # later reindexes are requested by the admin endpoint or watcher
+        await bot_init.areindex_worker()
+
+    async def startup_logic():
+        global bot_init, bot
+
+        try:
+            created = await asyncio.to_thread(create_bot)
+        except Exception as e:
+            # requests keep getting a 503
+            print(f"Creating the chatbot failed: {e}")
+            raise
+        bot = created.acompile()
+        bot_init = created
+
+        tasks.append(asyncio.create_task(session_cleanup_logic()))
+        tasks.append(asyncio.create_task(warmup_logic()))
+        tasks.append(asyncio.create_task(indexing_logic()))
+
+        # polls the knowledge sources for changes when enabled
+        if bot_init.watch_interval > 0:
+            tasks.append(asyncio.create_task(bot_init.awatch()))
+
+    tasks.append(asyncio.create_task(startup_logic()))
 
     try:
         yield  # Application runs here
     finally:
         # Shutdown logic
-        cleanup_task.cancel()
-        try:
-            await cleanup_task
-        except asyncio.CancelledError:
-            print("Cleanup task cancelled gracefully")
+        # an index build in progress finishes in its thread, the manifest
+        # is only saved once it completes
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        print("Background tasks cancelled gracefully")
 
 
 app = FastAPI(lifespan=lifespan)
 
-# chatbot instantiation
-bot_init = ChatBot()
-bot = bot_init.acompile()
+# every request is timed, stage timings can be sent in a Server-Timing
+# header and a sample of slow requests is logged with them
+app.add_middleware(
+    TimingMiddleware,
+    timing_headers=env_setting("EDUBOT_TIMING_HEADERS", False, bool),
+    slow_request_seconds=env_setting(
+        "EDUBOT_SLOW_REQUEST_SECONDS", None, float),
+    slow_request_sample=env_setting("EDUBOT_SLOW_REQUEST_SAMPLE", 1.0, float))
 
+# token expected in the X-Admin-Token header of admin endpoints, they're
+# disabled when it isn't set
+admin_token = env_setting("EDUBOT_ADMIN_TOKEN", None)
 
-@app.post('/chatbot')
-async def chatbot(prompt_data: PromptModel):
-    if (prompt_data.session_id is None):
-        # print(bot_init.memory.storage)
+# seconds a request may spend waiting for and running the llm calls
+request_timeout = env_setting("EDUBOT_REQUEST_TIMEOUT", 60.0, float)
+
+
+def ready_bot() -> ChatBot:
+    """returns the chatbot, requests are rejected until it's created"""
+    if bot_init is None:
+        raise HTTPException(
+            status_code=503, detail="EduBot is starting",
+            headers={"Retry-After": "5"})
+
+    return bot_init
+
+
+def overloaded(retry_after: int) -> HTTPException:
+    """returns the error sent when the llm queue can't take a request"""
+    return HTTPException(
+        status_code=503,
+        detail="EduBot is busy, please retry shortly",
+        headers={"Retry-After": str(retry_after)})
 
-        prompt_data.session_id = str(uuid.uuid4())
-        while prompt_data.session_id in bot_init.memory.storage:
-            prompt_data.session_id = str(uuid.uuid4())
-    elif (prompt_data.session_id not in bot_init.memory.storage):
-        # print(bot_init.memory.storage)
 
+def request_config(prompt_data: PromptModel) -> dict:
+    """returns the graph config of a request"""
+    return {"configurable": {
+        "thread_id": prompt_data.session_id,
+        "role": prompt_data.role,
+        "deadline": time.monotonic() + request_timeout
+        }}
+
+
+def resolve_session_id(prompt_data: PromptModel) -> None:
+    """assigns a new session id to prompts without a known session"""
+    if (prompt_data.session_id is None) or (
+            not bot_init.memory.has_session(prompt_data.session_id)):
         prompt_data.session_id = str(uuid.uuid4())
-        while prompt_data.session_id in bot_init.memory.storage:
+        while bot_init.memory.has_session(prompt_data.session_id):
             prompt_data.session_id = str(uuid.uuid4())
 
-    config = {"configurable": {
-            "thread_id": prompt_data.session_id,
-            "role": prompt_data.role
-            }
-        }
-    response = await bot.ainvoke({"messages": prompt_data.prompt}, config)
+
+@app.post('/chatbot')
+async def chatbot(prompt_data: PromptModel):
+    ready_bot()
+    resolve_session_id(prompt_data)
+
+    config = request_config(prompt_data)
+    try:
+        response = await bot.ainvoke(
+            {"messages": prompt_data.prompt}, config)
+    except (QueueFullError, QueueTimeoutError) as e:
+        raise overloaded(e.retry_after)
 
     return {
         "user_id": prompt_data.user_id,
@@ -94,8 +270,211 @@ async def chatbot(prompt_data: PromptModel):
         }
 
 
+@app.post('/chatbot/stream')
+async def chatbot_stream(prompt_data: StreamPromptModel):
+    """streams the answer as newline delimited json frames
+
+    "token" frames carry the answer as it's generated, "route" and
+    "retrieval" frames are sent when `events` is set and a final "end" frame
+    carries the session id and timestamp
+    """
+    if ready_bot().llm_limiter.is_full():
+        # the status can't change once streaming started
+        raise overloaded(bot_init.llm_limiter.retry_after())
+
+    resolve_session_id(prompt_data)
+
+    config = request_config(prompt_data)
+
+    def frame(data: dict) -> str:
+        return json.dumps(data) + "\n"
+
+    async def guarded(stream):
+        """passes the stream on, turning an overload into an error frame"""
+        try:
+            async for item in stream:
+                yield item
+        except (QueueFullError, QueueTimeoutError) as e:
+            yield "error", {"type": "error", "detail": str(e),
+                            "retry_after": e.retry_after}
+
+    async def frames():
+        # prefetched context is passed on by the "rag" node
+        retrieval_sent = False
+
+        stream = bot.astream(
+            {"messages": prompt_data.prompt}, config,
+            stream_mode=["messages", "updates"])
+
+        async for mode, chunk in guarded(stream):
+            if mode == "error":
+                yield frame(chunk)
+                return
+
+            if mode == "messages":
+                message, metadata = chunk
+                if metadata.get("langgraph_node") == "answer" and (
+                        message.content):
+                    yield frame({"type": "token", "content": message.content})
+                continue
+
+            for node, update in chunk.items():
+                if not update:
+                    continue
+
+                if node in ("canonical", "cache") and (
+                        update.get("route") == "end"):
+                    # canonical and cached answers arrive whole
+                    yield frame({"type": "token",
+                                 "content": update["messages"].content})
+                elif prompt_data.events and node == "router":
+                    yield frame({"type": "route",
+                                 "route": update["route"],
+                                 "confidence": update.get(
+                                     "route_confidence")})
+                elif prompt_data.events and update.get("context") and (
+                        not retrieval_sent):
+                    retrieval_sent = True
+                    yield frame({"type": "retrieval",
+                                 "documents": len(update["context"]),
+                                 "sources": sorted({
+                                     doc.metadata.get("source")
+                                     for doc in update["context"]})})
+
+        yield frame({
+            "type": "end",
+            "user_id": prompt_data.user_id,
+            "role": prompt_data.role,
+            "session_id": prompt_data.session_id,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+
+@app.post('/chatbot/batch')
+async def chatbot_batch(batch_data: BatchPromptModel):
+    """answers many single turn prompts, streaming newline delimited json
+    "result" (or "error") frames in completion order and a final "end"
+    frame
+
+    identical prompts of a role are answered once and reported for every
+    index they were sent at
+    """
+    llm_concurrency = ready_bot().llm_limiter.max_concurrency
+    max_concurrency = min(
+        batch_data.max_concurrency or llm_concurrency, llm_concurrency)
+    items = [item.model_dump() for item in batch_data.items]
+
+    def frame(data: dict) -> str:
+        return json.dumps(data) + "\n"
+
+    async def frames():
+        started = time.perf_counter()
+        unique = 0
+
+        # no request deadline, a batch can run for a while and each llm
+        # call is only bounded by the queue timeout
+        async for indexes, result in bot_init.abatch(
+                items, max_concurrency=max_concurrency):
+            unique += 1
+
+            for index in indexes:
+                item = items[index]
+
+                if isinstance(result, Exception):
+                    yield frame({"type": "error", "index": index,
+                                 "role": item["role"],
+                                 "detail": str(result)})
+                else:
+                    yield frame({"type": "result", "index": index,
+                                 "role": item["role"],
+                                 "prompt": item["prompt"],
+                                 "response": result})
+
+        yield frame({
+            "type": "end",
+            "user_id": batch_data.user_id,
+            "items": len(items),
+            "unique": unique,
+            "seconds": round(time.perf_counter() - started, 3),
+            "timestamp": datetime.now().isoformat()
+        })
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+
 @app.get('/health-check')
 async def healthcheck():
+    if not ready_bot().warmed_up:
+        # models are still loading
+        raise HTTPException(
+            status_code=503, detail="EduBot is warming up")
+
     return {
         "output": "Educify chatbot API is active!"
     }
+
+
+def check_admin_token(token: Optional[str]) -> None:
+    """rejects admin requests without the admin token"""
+    if admin_token is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if token is None or not secrets.compare_digest(token, admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post('/admin/reindex', status_code=202)
+async def reindex(x_admin_token: Optional[str] = Header(default=None)):
+    """schedules an incremental reindex of the knowledge sources, requests
+    are debounced and rate limited"""
+    check_admin_token(x_admin_token)
+
+    ready_bot().request_reindex()
+
+    return {"status": "scheduled", "indexing": bot_init.index_progress()}
+
+
+@app.get('/livez')
+async def livez():
+    return {"status": "alive"}
+
+
+@app.get('/readyz')
+async def readyz():
+    """ready once the models are warm, queries are answered without
+    retrieval until the first index is built"""
+    if bot_init is None:
+        return JSONResponse(
+            status_code=503,
+            content={"ready": False, "warmed_up": False, "indexing": None})
+
+    indexing = bot_init.index_progress()
+    ready = bot_init.warmed_up
+
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "warmed_up": bot_init.warmed_up,
+                 "indexing": indexing})
+
+
+@app.get('/stats')
+async def stats():
+    ready_bot()
+
+    return {
+        "sessions": bot_init.memory.stats(),
+        "llm_queue": bot_init.llm_limiter.stats(),
+        "retrieval_gate": bot_init.gate_stats,
+        "response_cache": (
+            bot_init.response_cache.stats()
+            if bot_init.response_cache is not None else None)
+    }
+
+
+@app.get('/metrics')
+async def metrics():
+    """latency, token, retrieval and routing metrics in the prometheus text
+    format"""
+    return Response(content=registry.render(), media_type=content_type)
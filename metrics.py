@@ -0,0 +1,273 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+# content type of the prometheus text exposition format
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+token_buckets = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+chunk_buckets = (0, 1, 2, 4, 8, 16, 32)
+
+# stage -> seconds spent in it by the current request, set by the
+# TimingMiddleware
+request_timings: ContextVar[Optional[dict]] = ContextVar(
+    "request_timings", default=None)
+
+
+def escape(value: str) -> str:
+    """escapes a label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def label_text(names: tuple[str, ...], values: tuple[str, ...],
+               extra: str = "") -> str:
+    """returns the {name="value",...} part of a sample"""
+    labels = [f'{name}="{escape(value)}"'
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """monotonic counter per label combination"""
+
+    def __init__(self, name: str, documentation: str,
+                 labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = tuple("none" if label is None else str(label)
+                    for label in labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} counter"]
+
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(
+                    f"{self.name}{label_text(self.labels, key)} "
+                    f"{format_value(value)}")
+
+        return lines
+
+
+class Histogram():
+    """bucketed distribution per label combination
+
+    an observation only increments its own bucket, buckets are made
+    cumulative when rendered
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = latency_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts (last one is +Inf), sum, count]
+        self.values: dict[tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        key = tuple("none" if label is None else str(label)
+                    for label in labels)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(
+                        self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    bucket = label_text(
+                        self.labels, key, f'le="{format_value(bound)}"')
+                    lines.append(
+                        f"{self.name}_bucket{bucket} {cumulative}")
+
+                labels = label_text(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+
+        return lines
+
+
+class Registry():
+    """metrics exposed together on the /metrics endpoint"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """returns every metric in the prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    "edubot_request_seconds", "HTTP request latency",
+    ("endpoint", "status")))
+node_seconds = registry.register(Histogram(
+    "edubot_node_seconds", "Graph node latency",
+    ("node", "role", "route")))
+llm_seconds = registry.register(Histogram(
+    "edubot_llm_seconds", "LLM call latency, excluding the queue wait",
+    ("llm", "role")))
+llm_queue_seconds = registry.register(Histogram(
+    "edubot_llm_queue_seconds", "Wait for an LLM concurrency slot",
+    ("llm",)))
+prompt_tokens = registry.register(Histogram(
+    "edubot_prompt_tokens", "Prompt tokens per LLM call",
+    ("llm", "role"), token_buckets))
+completion_tokens = registry.register(Histogram(
+    "edubot_completion_tokens", "Completion tokens per LLM call",
+    ("llm", "role"), token_buckets))
+embedding_seconds = registry.register(Histogram(
+    "edubot_embedding_seconds",
+    "Embedding model call latency, cache hits aren't sent to the model",
+    ("operation",)))
+search_seconds = registry.register(Histogram(
+    "edubot_search_seconds",
+    "Vector and BM25 search latency, including query embeddings",
+    ("role",)))
+retrieved_chunks = registry.register(Histogram(
+    "edubot_retrieved_chunks", "Chunks in the context of an answer",
+    ("role", "route"), chunk_buckets))
+routes = registry.register(Counter(
+    "edubot_routes_total", "Routing decisions",
+    ("route", "role", "source")))
+saver_seconds = registry.register(Histogram(
+    "edubot_saver_seconds", "Session store operation latency",
+    ("operation",)))
+
+
+def add_timing(name: str, seconds: float) -> None:
+    """adds time spent in a stage to the current request's timings"""
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(histogram: Histogram, *labels, timing: Optional[str] = None):
+    """observes the duration of the block, also adding it to the request's
+    timings under `timing`"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        histogram.observe(seconds, *labels)
+        if timing is not None:
+            add_timing(timing, seconds)
+
+
+class TimingMiddleware():
+    """asgi middleware timing every http request
+
+    optionally adds a Server-Timing header with the request's stages and
+    prints a sample (`slow_request_sample`) of the requests slower than
+    `slow_request_seconds` with their stages. a streamed response's header
+    only carries the stages completed before streaming started
+    """
+
+    def __init__(self, app, timing_headers: bool = False,
+                 slow_request_seconds: Optional[float] = None,
+                 slow_request_sample: float = 1.0):
+        self.app = app
+        self.timing_headers = timing_headers
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_request_sample = slow_request_sample
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.timing_headers:
+                    timings["total"] = time.perf_counter() - started
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", server_timing(timings))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            request_timings.reset(token)
+            seconds = time.perf_counter() - started
+
+            # the route template keeps the endpoint label bounded
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            request_seconds.observe(seconds, endpoint, status)
+
+            if self.slow_request_seconds is not None and (
+                    seconds >= self.slow_request_seconds) and (
+                    random.random() < self.slow_request_sample):
+                timings.pop("total", None)
+                stages = ", ".join(
+                    f"{name}={stage * 1000:.0f}ms"
+                    for name, stage in timings.items())
+                print(f"Slow request {scope['method']} {endpoint} {status} "
+                      f"{seconds:.3f}s: {stages}")
+
+
+def server_timing(timings: dict) -> bytes:
+    """returns a Server-Timing header value, durations in milliseconds"""
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}"
+        for name, seconds in timings.items()).encode("latin-1")
@@ -0,0 +1,480 @@
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+
+
+# words too common to tell chunks apart
+stop_words = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does",
+    "for", "from", "how", "i", "if", "in", "is", "it", "my", "of", "on",
+    "or", "the", "to", "what", "when", "where", "which", "who", "why",
+    "with", "you", "your"
+))
+
+
+def tokenize(text: str) -> list[str]:
+    """splits text into lowercase terms, dropping stop words"""
+    return [
+        term for term in re.findall(r"\w+", text.lower())
+        if term not in stop_words]
+
+
+class BM25Index():
+    """in-memory BM25 inverted index over the indexed chunks
+
+    chunks are added and removed by id so the index follows incremental
+    ingestion, it's persisted as json next to the vector store
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # chunk id -> {"page_content", "metadata", "terms", "length"}
+        self.documents: dict[str, dict] = {}
+        # term -> {chunk id: term frequency}
+        self.postings: dict[str, dict[str, int]] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, ids: list[str], documents: list[Document]) -> None:
+        """indexes chunks under their ids, replacing chunks with the same
+        id"""
+        self.remove([chunk_id for chunk_id in ids
+                     if chunk_id in self.documents])
+
+        for chunk_id, document in zip(ids, documents):
+            terms = Counter(tokenize(document.page_content))
+            self._insert(chunk_id, {
+                "page_content": document.page_content,
+                "metadata": document.metadata,
+                "terms": dict(terms),
+                "length": sum(terms.values())
+            })
+
+    def _insert(self, chunk_id: str, entry: dict) -> None:
+        self.documents[chunk_id] = entry
+        self.total_length += entry["length"]
+
+        for term, frequency in entry["terms"].items():
+            self.postings.setdefault(term, {})[chunk_id] = frequency
+
+    def remove(self, ids: list[str]) -> None:
+        """drops chunks from the index"""
+        for chunk_id in ids:
+            entry = self.documents.pop(chunk_id, None)
+            if entry is None:
+                continue
+
+            self.total_length -= entry["length"]
+            for term in entry["terms"]:
+                postings = self.postings[term]
+                del postings[chunk_id]
+                if not postings:
+                    del self.postings[term]
+
+    def copy(self) -> "BM25Index":
+        """returns an independent copy, chunk entries are shared since
+        they're never modified"""
+        index = BM25Index(self.k1, self.b)
+        for chunk_id, entry in self.documents.items():
+            index._insert(chunk_id, entry)
+
+        return index
+
+    def search(self, query: str, k: int = 4,
+               role: Optional[str] = None) -> list[tuple[Document, float]]:
+        """returns the k best matching chunks of a role (or of every role)
+        with their BM25 scores"""
+        if not self.documents:
+            return []
+
+        count = len(self.documents)
+        average_length = self.total_length / count
+        scores: dict[str, float] = {}
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(
+                1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            for chunk_id, frequency in postings.items():
+                entry = self.documents[chunk_id]
+                if role is not None and (
+                        entry["metadata"].get("role") != role):
+                    continue
+
+                norm = self.k1 * (
+                    1 - self.b + self.b * entry["length"] / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + (
+                    idf * frequency * (self.k1 + 1) / (frequency + norm))
+
+        return [
+            (Document(page_content=self.documents[chunk_id]["page_content"],
+                      metadata=self.documents[chunk_id]["metadata"],
+                      id=chunk_id), score)
+            for chunk_id, score in heapq.nlargest(
+                k, scores.items(), key=lambda item: item[1])]
+
+    def save(self, file_path: str) -> None:
+        """atomically saves the index"""
+        temp_path = f"{file_path}.tmp"
+
+        with open(temp_path, "w") as data_file:
+            json.dump({"k1": self.k1, "b": self.b,
+                       "documents": self.documents}, data_file)
+
+        os.replace(temp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> Optional["BM25Index"]:
+        """loads a saved index, returns None if it's missing or
+        unreadable"""
+        try:
+            with open(file_path, "r") as data_file:
+                data = json.load(data_file)
+        except Exception:
+            return None
+
+        index = cls(data["k1"], data["b"])
+        for chunk_id, entry in data["documents"].items():
+            index._insert(chunk_id, entry)
+
+        return index
+
+
+def is_decisive(results: list[tuple[Document, float]],
+                ratio: float, min_score: float) -> bool:
+    """whether the best lexical match scores at least min_score and beats
+    the runner-up by ratio, a ratio of 0 never is
+
+    the floor keeps a lone hit on one rare term from being decisive
+    """
+    if not ratio or not results or results[0][1] < min_score:
+        return False
+    if len(results) == 1:
+        return True
+
+    return results[0][1] >= ratio * results[1][1]
+
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], k: int = 60,
+                           limit: Optional[int] = None) -> list[Document]:
+    """merges ranked lists of chunks by reciprocal rank fusion, chunks are
+    matched by id"""
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document.id or document.page_content
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+            documents.setdefault(key, document)
+
+    fused = sorted(scores, key=scores.get, reverse=True)
+    if limit is not None:
+        fused = fused[:limit]
+
+    return [documents[key] for key in fused]
+
+
+class NumpyVectorStore():
+    """vector store keeping normalized chunk embeddings in a contiguous
+    float32 matrix
+
+    a store is built once, saved as <name>.npy (the matrix) and
+    <name>.chunks.json (ids, texts and metadata) and loaded read-only as a
+    memory map, so every worker shares one page cache copy. search is a
+    single matrix product with an argpartition top-k, roles are filtered
+    with precomputed boolean masks
+    """
+
+    def __init__(self, embeddings: Embeddings, directory: str, name: str):
+        self.embeddings = embeddings
+        self.directory = directory
+        self.name = name
+
+        self.ids: list[str] = []
+        self.documents: list[dict] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.role_masks: dict[str, np.ndarray] = {}
+        # rows added since the store was created, saved by save()
+        self.pending: list[np.ndarray] = []
+
+    @property
+    def matrix_path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.npy")
+
+    @property
+    def chunks_path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.chunks.json")
+
+    @classmethod
+    def load(cls, embeddings: Embeddings, directory: str,
+             name: str) -> "NumpyVectorStore":
+        """opens a saved store, an empty store is returned if it doesn't
+        exist yet"""
+        store = cls(embeddings, directory, name)
+
+        if not os.path.exists(store.chunks_path):
+            return store
+
+        with open(store.chunks_path, "r") as data_file:
+            chunks = json.load(data_file)
+
+        store.ids = chunks["ids"]
+        store.documents = chunks["documents"]
+        store.matrix = np.load(store.matrix_path, mmap_mode="r")
+        store._index_roles()
+
+        return store
+
+    def _index_roles(self) -> None:
+        roles = np.array([
+            document["metadata"].get("role", "") or ""
+            for document in self.documents])
+        self.role_masks = {
+            role: roles == role for role in set(roles.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add_vectors(self, ids: list[str], vectors, documents: list[dict]):
+        """adds chunks with their embeddings, documents are
+        {"page_content", "metadata"} dicts"""
+        if not ids:
+            return
+
+        rows = np.asarray(vectors, dtype=np.float32)
+        rows = rows / np.maximum(
+            np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+
+        self.pending.append(rows)
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+
+    def add_documents(self, documents: list[Document], ids: list[str]):
+        """embeds and adds chunks"""
+        self.add_vectors(
+            ids,
+            self.embeddings.embed_documents(
+                [document.page_content for document in documents]),
+            [{"page_content": document.page_content,
+              "metadata": document.metadata} for document in documents])
+
+    def get(self, ids: list[str]) -> tuple[list[str], np.ndarray, list[dict]]:
+        """returns the ids, embeddings and documents of the given chunks
+        that are in the store"""
+        positions = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        rows = [positions[chunk_id] for chunk_id in ids
+                if chunk_id in positions]
+
+        return ([self.ids[row] for row in rows],
+                np.asarray(self.matrix[rows]),
+                [self.documents[row] for row in rows])
+
+    def save(self) -> None:
+        """writes the matrix and chunks, the store is memory mapped
+        afterwards"""
+        matrix = np.concatenate(self.pending) if self.pending else (
+            np.zeros((0, 0), dtype=np.float32))
+        self.pending = []
+
+        temp_path = f"{self.matrix_path}.tmp.npy"
+        np.save(temp_path, matrix)
+        os.replace(temp_path, self.matrix_path)
+
+        temp_path = f"{self.chunks_path}.tmp"
+        with open(temp_path, "w") as data_file:
+            json.dump({"ids": self.ids, "documents": self.documents},
+                      data_file)
+        os.replace(temp_path, self.chunks_path)
+
+        self.matrix = np.load(self.matrix_path, mmap_mode="r")
+        self._index_roles()
+
+    def _document(self, row: int) -> Document:
+        return Document(page_content=self.documents[row]["page_content"],
+                        metadata=self.documents[row]["metadata"],
+                        id=self.ids[row])
+
+    def search_vectors(self, vectors, k: int = 4,
+                       role: Optional[str] = None
+                       ) -> list[list[tuple[Document, float]]]:
+        """returns the k most similar chunks with their cosine similarity
+        for every query vector"""
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+
+        if not self.ids or self.matrix.size == 0:
+            return [[] for _ in queries]
+
+        queries = queries / np.maximum(
+            np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ self.matrix.T
+
+        if role is not None:
+            mask = self.role_masks.get(role)
+            if mask is None:
+                return [[] for _ in queries]
+            scores[:, ~mask] = -np.inf
+            k = min(k, int(mask.sum()))
+
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return [[] for _ in queries]
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, rows in zip(scores, top):
+            rows = rows[np.argsort(-row_scores[rows])]
+            results.append([
+                (self._document(row), float(row_scores[row]))
+                for row in rows.tolist()])
+
+        return results
+
+    @staticmethod
+    def _role(filter: Optional[dict]) -> Optional[str]:
+        return (filter or {}).get("role")
+
+    def similarity_search_with_relevance_scores(
+            self, query: str, k: int = 4, filter: Optional[dict] = None
+            ) -> list[tuple[Document, float]]:
+        return self.search_vectors(
+            self.embeddings.embed_query(query), k, self._role(filter))[0]
+
+    async def asimilarity_search_with_relevance_scores(
+            self, query: str, k: int = 4, filter: Optional[dict] = None
+            ) -> list[tuple[Document, float]]:
+        return self.search_vectors(
+            await self.embeddings.aembed_query(query), k,
+            self._role(filter))[0]
+
+    def similarity_search(self, query: str, k: int = 4,
+                          filter: Optional[dict] = None) -> list[Document]:
+        return [document for document, _ in (
+            self.similarity_search_with_relevance_scores(query, k, filter))]
+
+    async def asimilarity_search(self, query: str, k: int = 4,
+                                 filter: Optional[dict] = None
+                                 ) -> list[Document]:
+        return [document for document, _ in (
+            await self.asimilarity_search_with_relevance_scores(
+                query, k, filter))]
+
+    async def abatch_similarity_search(
+            self, queries: list[str], k: int = 4,
+            filter: Optional[dict] = None
+            ) -> list[list[tuple[Document, float]]]:
+        """searches several queries with a single embedding batch and
+        matrix product"""
+        if not queries:
+            return []
+
+        return self.search_vectors(
+            await self.embeddings.aembed_documents(queries), k,
+            self._role(filter))
+
+
+def merge_chunks(documents: list[Document]) -> list[str]:
+    """merges chunks into non-overlapping passages, ordered by their
+    position in their source
+
+    only chunks sharing one offset space, the same (source, page), are
+    stitched together by "start_index" so text shared by overlapping chunks
+    appears once. csv rows (which all start at 0) and chunks without a
+    position are kept as they are
+    """
+    groups: dict = {}
+    unmerged = []
+
+    for document in documents:
+        start = document.metadata.get("start_index")
+        if start is None or document.metadata.get("row") is not None:
+            unmerged.append(document.page_content)
+        else:
+            groups.setdefault(
+                (document.metadata.get("source", ""),
+                 document.metadata.get("page") or 0), []).append(
+                (start, document.page_content))
+
+    passages = []
+    for group in sorted(groups):
+        chunks = sorted(groups[group], key=lambda chunk: chunk[0])
+        start, text = chunks[0]
+
+        for next_start, next_text in chunks[1:]:
+            end = start + len(text)
+            if next_start <= end:
+                # overlapping or adjacent, only the new text is appended
+                text += next_text[end - next_start:]
+            else:
+                passages.append(text)
+                start, text = next_start, next_text
+
+        passages.append(text)
+
+    return passages + unmerged
+
+
+def build_context(documents: list[Document], token_budget: int,
+                  source_texts: Optional[dict[str, str]] = None,
+                  count_tokens=None) -> str:
+    """builds the prompt context from ranked chunks
+
+    sources are ordered by their best ranked chunk. a source whose whole
+    text (from source_texts) fits the remaining budget is included whole,
+    otherwise its chunks are merged into passages. duplicate passages are
+    dropped and passages beyond the token budget are left out
+    """
+    if count_tokens is None:
+        def count_tokens(text):
+            return len(text) // 4 + 1
+
+    source_texts = source_texts or {}
+    sources: dict[str, list[Document]] = {}
+    for document in documents:
+        sources.setdefault(
+            document.metadata.get("source", ""), []).append(document)
+
+    sections = []
+    seen = set()
+    remaining = token_budget
+
+    for source, chunks in sources.items():
+        whole_text = source_texts.get(source)
+        if whole_text is not None and count_tokens(whole_text) <= remaining:
+            passages = [whole_text]
+        else:
+            passages = merge_chunks(chunks)
+
+        for passage in passages:
+            key = " ".join(passage.split())
+            if not key or key in seen:
+                continue
+
+            tokens = count_tokens(passage)
+            if tokens > remaining:
+                continue
+
+            seen.add(key)
+            sections.append(passage.strip())
+            remaining -= tokens
+
+    if not sections and documents:
+        # the best chunk alone is over budget, it's cut to size
+        sections.append(documents[0].page_content[:max(token_budget, 0) * 4])
+
+    return "\n\n".join(sections)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+# the application modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from langchain_core.embeddings import Embeddings  # noqa: E402
+
+from benchmarks.ollama_stub import embed  # noqa: E402
+from chatbot import ChatBot  # noqa: E402
+from embeddings import CachedEmbeddings  # noqa: E402
+
+
+class HashEmbeddings(Embeddings):
+    """the ollama stub's hashed bag of words embeddings, without a server"""
+
+    def embed_documents(self, texts):
+        return [embed(text, 64) for text in texts]
+
+    def embed_query(self, text):
+        return embed(text, 64)
+
+
+@pytest.fixture
+def make_bot(tmp_path, monkeypatch):
+    """returns a factory of numpy backed chatbots (workers) sharing an index,
+    knowledge sources and embedding cache in tmp_path"""
+    def initialize_embedding(self):
+        if self.embeddings is None:
+            self.embeddings = CachedEmbeddings(
+                HashEmbeddings(), "hash",
+                cache_path=self.embedding_cache_path)
+        return self.embeddings
+
+    monkeypatch.setattr(ChatBot, "initialize_embedding", initialize_embedding)
+    (tmp_path / "data_sources").mkdir(exist_ok=True)
+
+    def factory(**kwargs):
+        settings = {
+            "data_path": str(tmp_path / "data_sources"),
+            "db_location": str(tmp_path / "vector_store"),
+            "manifest_path": str(tmp_path / "manifest.json"),
+            "embedding_cache_path": str(tmp_path / "cache.sqlite"),
+            "vector_backend": "numpy",
+            "ingestion_workers": 1,
+            "index_on_init": False,
+            **kwargs}
+        return ChatBot(**settings)
+
+    return factory
@@ -0,0 +1,107 @@
+from langchain.schema import Document
+
+from retrieval import BM25Index, is_decisive, reciprocal_rank_fusion
+
+
+def index_of(texts, role="student"):
+    index = BM25Index()
+    index.add([f"c{number}" for number in range(len(texts))],
+              [Document(page_content=text, metadata={"role": role})
+               for text in texts])
+    return index
+
+
+def hit(chunk_id, score):
+    return Document(page_content=chunk_id, id=chunk_id), score
+
+
+def test_search_ranks_matching_chunks():
+    index = index_of(["cancel a lesson from the schedule",
+                      "refund of unused credits", "lesson notes"])
+
+    results = index.search("how do I cancel a lesson", k=2)
+
+    assert [document.id for document, _ in results] == ["c0", "c2"]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_search_filters_by_role():
+    index = index_of(["cancel a lesson"])
+    index.add(["t0"], [Document(page_content="cancel a lesson",
+                                metadata={"role": "teacher"})])
+
+    assert [document.id for document, _ in index.search(
+        "cancel", role="teacher")] == ["t0"]
+    assert len(index.search("cancel")) == 2
+
+
+def test_removed_chunks_are_not_found():
+    index = index_of(["cancel a lesson", "refund credits"])
+    index.remove(["c0"])
+
+    assert index.search("cancel") == []
+    assert len(index) == 1
+
+
+def test_replacing_a_chunk_keeps_lengths_consistent():
+    index = index_of(["cancel a lesson"])
+    index.add(["c0"], [Document(page_content="refund credits",
+                                metadata={"role": "student"})])
+
+    assert index.search("cancel") == []
+    assert index.total_length == 2
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index = index_of(["cancel a lesson", "refund credits"])
+    path = str(tmp_path / "index.json")
+    index.save(path)
+
+    loaded = BM25Index.load(path)
+
+    assert loaded.search("refund") == index.search("refund")
+    assert BM25Index.load(str(tmp_path / "missing.json")) is None
+
+
+def test_copy_is_independent():
+    index = index_of(["cancel a lesson"])
+    copy = index.copy()
+    copy.remove(["c0"])
+
+    assert len(index) == 1 and len(copy) == 0
+
+
+def test_lone_weak_hit_is_not_decisive():
+    assert not is_decisive([hit("a", 6.2)], 1.5, 10.0)
+
+
+def test_lone_strong_hit_is_decisive():
+    assert is_decisive([hit("a", 12.0)], 1.5, 10.0)
+
+
+def test_decisive_needs_the_ratio_and_the_floor():
+    assert is_decisive([hit("a", 25.0), hit("b", 9.0)], 1.5, 10.0)
+    assert not is_decisive([hit("a", 12.0), hit("b", 9.0)], 1.5, 10.0)
+    assert not is_decisive([hit("a", 9.0), hit("b", 1.0)], 1.5, 10.0)
+
+
+def test_zero_ratio_disables_the_fast_path():
+    assert not is_decisive([hit("a", 50.0)], 0, 10.0)
+    assert not is_decisive([], 1.5, 10.0)
+
+
+def test_fusion_rewards_chunks_ranked_by_both_lists():
+    a, b, c = (Document(page_content=name, id=name) for name in "abc")
+
+    fused = reciprocal_rank_fusion([[a, b], [b, c]])
+
+    assert [document.id for document in fused] == ["b", "a", "c"]
+
+
+def test_fusion_limit_and_content_keys():
+    first = Document(page_content="same text")
+    second = Document(page_content="same text")
+
+    fused = reciprocal_rank_fusion([[first], [second]], limit=1)
+
+    assert fused == [first]
@@ -0,0 +1,88 @@
+import asyncio
+
+from answers import CanonicalAnswers
+
+
+def write_article(tmp_path):
+    directory = tmp_path / "data_sources" / "student"
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "how-do-i-cancel-a-lesson.txt").write_text(
+        "open the lesson and press cancel", encoding="utf-8")
+
+
+def canonical_bot(tmp_path, make_bot, generated, **kwargs):
+    bot = make_bot(
+        canonical_answers=True,
+        canonical_answers_path=str(tmp_path / "canonical_answers.json"),
+        **kwargs)
+
+    async def acanonical_entry(role, file_name, content_hash):
+        generated.append(file_name)
+        await asyncio.sleep(0.05)
+        return {"role": role, "file_name": file_name, "hash": content_hash,
+                "question": "How do I cancel a lesson?", "paraphrases": [],
+                "answer": "press cancel"}
+
+    bot.acanonical_entry = acanonical_entry
+    return bot
+
+
+def test_a_sync_build_inside_an_event_loop_skips_the_answers(
+        tmp_path, make_bot):
+    write_article(tmp_path)
+
+    async def create():
+        return canonical_bot(tmp_path, make_bot, [], index_on_init=True)
+
+    bot = asyncio.run(create())
+
+    assert bot.index_state == "ready"
+    assert bot.canonical_answers is None
+
+
+def test_a_single_worker_generates_the_answers(tmp_path, make_bot):
+    write_article(tmp_path)
+    generated = []
+    workers = [canonical_bot(tmp_path, make_bot, generated)
+               for _ in range(3)]
+
+    async def build():
+        await workers[0].abuild_index()
+        await asyncio.gather(*(
+            worker.abuild_index() for worker in workers[1:]))
+
+    asyncio.run(build())
+
+    assert generated == ["how-do-i-cancel-a-lesson.txt"]
+    assert all(
+        list(worker.canonical_answers.entries) == [
+            "student/how-do-i-cancel-a-lesson.txt"] for worker in workers)
+
+
+def test_workers_wait_for_the_answers_being_generated(tmp_path, make_bot):
+    write_article(tmp_path)
+    generated = []
+    workers = [canonical_bot(tmp_path, make_bot, generated)
+               for _ in range(3)]
+    manifest = workers[0].build_index()
+
+    async def precompute():
+        await asyncio.gather(*(
+            worker.aprecompute_answers(manifest) for worker in workers))
+
+    asyncio.run(precompute())
+
+    assert generated == ["how-do-i-cancel-a-lesson.txt"]
+    assert all(worker.canonical_answers.entries for worker in workers)
+
+
+def test_saves_leave_no_temporary_files(tmp_path):
+    answers = CanonicalAnswers(str(tmp_path / "canonical_answers.json"))
+    answers.entries = {"student/a.txt": {"question": "a?"}}
+
+    answers.save()
+    answers.save()
+
+    assert [path.name for path in tmp_path.iterdir()] == [
+        "canonical_answers.json"]
+    assert CanonicalAnswers.load(answers.file_path).entries == answers.entries
@@ -0,0 +1,77 @@
+from langchain.schema import Document
+
+from retrieval import build_context, merge_chunks
+
+
+def chunk(text, start=None, **metadata):
+    if start is not None:
+        metadata["start_index"] = start
+    return Document(page_content=text, metadata=metadata)
+
+
+def test_overlapping_text_chunks_are_stitched():
+    text = "How do I cancel a lesson? Open the schedule and pick cancel."
+    chunks = [chunk(text[20:], 20, source="a.txt"),
+              chunk(text[:30], 0, source="a.txt")]
+
+    assert merge_chunks(chunks) == [text]
+
+
+def test_distant_text_chunks_stay_apart():
+    chunks = [chunk("first part", 0, source="a.txt"),
+              chunk("later part", 500, source="a.txt")]
+
+    assert merge_chunks(chunks) == ["first part", "later part"]
+
+
+def test_pdf_pages_are_merged_separately():
+    chunks = [chunk("page one text", 0, source="a.pdf", page=0),
+              chunk("page two text", 0, source="a.pdf", page=1),
+              chunk("one text more", 5, source="a.pdf", page=0)]
+
+    assert merge_chunks(chunks) == ["page one text more", "page two text"]
+
+
+def test_sources_are_not_stitched_together():
+    chunks = [chunk("alpha beta", 0, source="a.txt"),
+              chunk("gamma delta", 3, source="b.txt")]
+
+    assert sorted(merge_chunks(chunks)) == ["alpha beta", "gamma delta"]
+
+
+def test_csv_rows_are_kept_whole():
+    rows = [chunk("question: payment\nanswer: Use a card or PayPal", 0,
+                  source="faq.csv", row=0),
+            chunk("question: refunds\nanswer: Refunds of cancellation", 0,
+                  source="faq.csv", row=1)]
+
+    assert merge_chunks(rows) == [row.page_content for row in rows]
+
+
+def test_unpositioned_chunks_are_kept():
+    assert merge_chunks([chunk("no offset", source="a.txt")]) == [
+        "no offset"]
+
+
+def test_context_prefers_whole_short_sources():
+    chunks = [chunk("cancel", 0, source="a.txt")]
+
+    context = build_context(chunks, 100, {"a.txt": "How to cancel: easily"})
+
+    assert context == "How to cancel: easily"
+
+
+def test_context_drops_duplicates_and_respects_budget():
+    chunks = [chunk("same passage", 0, source="a.txt"),
+              chunk("same  passage", 0, source="b.txt"),
+              chunk("x" * 400, 0, source="c.txt")]
+
+    context = build_context(chunks, 20)
+
+    assert context == "same passage"
+
+
+def test_context_cuts_an_oversized_best_chunk():
+    context = build_context([chunk("y" * 400, 0, source="a.txt")], 10)
+
+    assert context == "y" * 40
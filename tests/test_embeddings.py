@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+from embeddings import CachedEmbeddings
+
+
+class CountingEmbeddings(Embeddings):
+    """embeds a text as [its length], counting the texts sent"""
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+def cached(tmp_path):
+    model = CountingEmbeddings()
+    return model, CachedEmbeddings(
+        model, "model", cache_path=str(tmp_path / "cache.sqlite"))
+
+
+def test_only_misses_are_embedded(tmp_path):
+    model, embeddings = cached(tmp_path)
+
+    vectors = asyncio.run(embeddings.aembed_documents(["a", "bb", "a"]))
+    assert vectors == [[1.0], [2.0], [1.0]]
+    assert model.embedded == 2
+
+    # formatting-only differences share a vector
+    assert embeddings.embed_documents(["bb ", "ccc"]) == [[2.0], [3.0]]
+    assert model.embedded == 3
+
+
+def test_queries_are_served_from_the_persisted_cache(tmp_path):
+    model, embeddings = cached(tmp_path)
+    embeddings.embed_documents(["question"])
+
+    _, restarted = cached(tmp_path)
+    restarted.embeddings = model
+
+    assert asyncio.run(restarted.aembed_query("question")) == [8.0]
+    assert model.embedded == 1
+
+
+def test_async_paths_keep_sqlite_off_the_event_loop(tmp_path):
+    model, embeddings = cached(tmp_path)
+    threads = set()
+
+    def record(method):
+        def recorded(*args):
+            threads.add(threading.get_ident())
+            return method(*args)
+        return recorded
+
+    embeddings._load = record(embeddings._load)
+    embeddings._save = record(embeddings._save)
+
+    async def run():
+        await embeddings.aembed_query("query")
+        await embeddings.aembed_documents(["document"])
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+
+    assert threads and loop_thread not in threads
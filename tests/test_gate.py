@@ -0,0 +1,59 @@
+import asyncio
+from types import SimpleNamespace
+
+from langchain.schema import Document
+
+from chatbot import ChatBot
+
+
+class FakeEmbeddings():
+    """maps texts to fixed vectors"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    async def aembed_query(self, text):
+        return self.vectors[text]
+
+    async def aembed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+
+def gate():
+    bot = SimpleNamespace(
+        relevance_threshold=0.5, relevance_margin=0.1, judge_band=0.15,
+        gate_stats={"scored": 0, "judged": 0, "widened": 0, "dropped": 0})
+    bot.score_retrieval = lambda relevance: ChatBot.score_retrieval(
+        bot, relevance)
+    # any embedding raises a KeyError
+    bot.initialize_embedding = lambda: FakeEmbeddings({})
+    return bot
+
+
+def test_scores_above_the_threshold_are_sufficient():
+    assert ChatBot.score_retrieval(gate(), [0.7, 0.6]) is True
+
+
+def test_scores_below_the_band_are_insufficient():
+    assert ChatBot.score_retrieval(gate(), [0.3, 0.1]) is False
+    assert ChatBot.score_retrieval(gate(), []) is False
+    assert ChatBot.score_retrieval(gate(), None) is False
+
+
+def test_a_clear_lead_in_the_band_is_sufficient():
+    assert ChatBot.score_retrieval(gate(), [0.45, 0.3]) is True
+
+
+def test_a_close_call_in_the_band_is_left_to_the_judge():
+    assert ChatBot.score_retrieval(gate(), [0.45, 0.42]) is None
+
+
+def test_lexical_fast_path_matches_are_sufficient_without_embeddings():
+    bot = gate()
+    context = [Document(page_content="refund of a lesson credit")]
+
+    assert asyncio.run(ChatBot.ajudge_retrieval(
+        bot, "refund", context, None, None))
+    assert not asyncio.run(ChatBot.ajudge_retrieval(
+        bot, "refund", [], None, None))
+    assert bot.gate_stats["scored"] == 2
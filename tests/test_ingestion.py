@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import ingestion
+from ingestion import batched, iter_chunks
+
+
+def write_sources(tmp_path, count):
+    jobs = []
+    for number in range(count):
+        path = tmp_path / f"article-{number}.txt"
+        path.write_text(f"article {number} " * 50, encoding="utf-8")
+        jobs.append(("student", str(path)))
+    return jobs
+
+
+def test_inline_chunks_carry_role_and_offsets(tmp_path):
+    jobs = write_sources(tmp_path, 2)
+
+    results = list(iter_chunks(jobs, 200, 20, max_workers=1))
+
+    assert [file_path for _, file_path, _ in results] == [
+        file_path for _, file_path in jobs]
+    for role, _, chunks in results:
+        assert chunks and all(
+            chunk.metadata["role"] == role and
+            "start_index" in chunk.metadata for chunk in chunks)
+
+
+def test_pool_keeps_a_bounded_window(tmp_path, monkeypatch):
+    submitted = []
+    contexts = []
+
+    class RecordingExecutor(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            contexts.append(kwargs["mp_context"].get_start_method())
+            super().__init__(*args, **kwargs)
+
+        def submit(self, *args, **kwargs):
+            submitted.append(args[1])
+            return super().submit(*args, **kwargs)
+
+    monkeypatch.setattr(ingestion, "ProcessPoolExecutor", RecordingExecutor)
+    jobs = write_sources(tmp_path, 12)
+
+    chunks = iter_chunks(jobs, 200, 20, max_workers=2)
+    next(chunks)
+    assert len(submitted) <= 4
+
+    rest = list(chunks)
+    assert len(rest) == 11
+    assert sorted(submitted) == sorted(file_path for _, file_path in jobs)
+    assert contexts == ["spawn"]
+
+
+def test_batched_groups_a_stream():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+import main
+
+
+def request(method, path, **kwargs):
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+                transport=transport, base_url="http://test") as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+def test_requests_are_rejected_until_the_bot_is_created(monkeypatch):
+    monkeypatch.setattr(main, "bot_init", None)
+    monkeypatch.setattr(main, "bot", None)
+
+    assert request("GET", "/livez").status_code == 200
+    assert request("GET", "/readyz").status_code == 503
+    assert request("GET", "/health-check").status_code == 503
+    assert request("GET", "/stats").status_code == 503
+
+    response = request("POST", "/chatbot", json={
+        "user_id": "user", "prompt": "hello"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+
+
+def test_batch_concurrency_is_validated_and_capped(monkeypatch):
+    seen = []
+
+    async def abatch(items, max_concurrency):
+        seen.append(max_concurrency)
+        for index, item in enumerate(items):
+            yield [index], "answer"
+
+    bot = SimpleNamespace(
+        llm_limiter=SimpleNamespace(max_concurrency=4), abatch=abatch)
+    monkeypatch.setattr(main, "bot_init", bot)
+    items = [{"prompt": "hello"}]
+
+    response = request("POST", "/chatbot/batch", json={
+        "user_id": "user", "items": items, "max_concurrency": 0})
+    assert response.status_code == 422
+
+    for requested in (None, 2, 64):
+        response = request("POST", "/chatbot/batch", json={
+            "user_id": "user", "items": items,
+            "max_concurrency": requested})
+        assert response.status_code == 200
+
+    assert seen == [4, 2, 4]
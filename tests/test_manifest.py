@@ -0,0 +1,135 @@
+import json
+
+from retrieval import NumpyVectorStore
+
+
+def write(tmp_path, name, text, role="student"):
+    directory = tmp_path / "data_sources" / role
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / name).write_text(text, encoding="utf-8")
+
+
+def manifest(tmp_path):
+    with open(tmp_path / "manifest.json") as manifest_file:
+        return json.load(manifest_file)
+
+
+def stored_ids(bot):
+    store = NumpyVectorStore.load(
+        bot.initialize_embedding(), bot.db_location, bot.active_collection)
+    return set(store.ids)
+
+
+def chunk_ids(tmp_path, name, role="student"):
+    return manifest(tmp_path)["files"][role][name]["chunk_ids"]
+
+
+def indexed(tmp_path, make_bot, **kwargs):
+    write(tmp_path, "cancel.txt", "open the lesson and press cancel")
+    write(tmp_path, "refund.txt", "refunds return credits to the wallet")
+    write(tmp_path, "payout.txt", "payouts are sent monthly", "teacher")
+    bot = make_bot(**kwargs)
+    bot.build_index()
+    return bot
+
+
+def test_a_first_build_indexes_every_file(tmp_path, make_bot):
+    bot = indexed(tmp_path, make_bot)
+
+    assert bot.files_to_index == 3
+    assert manifest(tmp_path)["collection"] == "edubot-v1"
+    assert stored_ids(bot) == {
+        *chunk_ids(tmp_path, "cancel.txt"),
+        *chunk_ids(tmp_path, "refund.txt"),
+        *chunk_ids(tmp_path, "payout.txt", "teacher")}
+
+
+def test_unchanged_files_keep_the_collection(tmp_path, make_bot):
+    bot = indexed(tmp_path, make_bot)
+
+    bot.build_index()
+
+    assert manifest(tmp_path)["collection"] == "edubot-v1"
+    assert bot.active_collection == "edubot-v1"
+
+
+def test_only_added_and_edited_files_are_indexed(tmp_path, make_bot):
+    bot = indexed(tmp_path, make_bot)
+    write(tmp_path, "jitsi.txt", "the jitsi classroom opens from a lesson")
+    write(tmp_path, "refund.txt", "refunds take five business days")
+
+    bot.build_index()
+
+    assert bot.files_to_index == 2
+    assert bot.active_collection == "edubot-v2"
+    documents = {
+        document.page_content
+        for document, _ in bot.bm25.search("refunds", k=4)}
+    assert documents == {"refunds take five business days"}
+    assert len(stored_ids(bot)) == 4
+
+
+def test_deleted_and_restored_files(tmp_path, make_bot):
+    bot = indexed(tmp_path, make_bot)
+    removed = chunk_ids(tmp_path, "refund.txt")
+    (tmp_path / "data_sources" / "student" / "refund.txt").unlink()
+
+    bot.build_index()
+
+    assert bot.files_to_index == 0
+    assert "refund.txt" not in manifest(tmp_path)["files"]["student"]
+    assert not stored_ids(bot) & set(removed)
+
+    write(tmp_path, "refund.txt", "refunds return credits to the wallet")
+    bot.build_index()
+
+    assert bot.files_to_index == 1
+    assert set(removed) <= stored_ids(bot)
+    assert bot.active_collection == "edubot-v3"
+
+
+def test_a_deleted_role_directory_removes_its_chunks(tmp_path, make_bot):
+    bot = indexed(tmp_path, make_bot)
+    payout = chunk_ids(tmp_path, "payout.txt", "teacher")
+    (tmp_path / "data_sources" / "teacher" / "payout.txt").unlink()
+    (tmp_path / "data_sources" / "teacher").rmdir()
+
+    bot.build_index()
+
+    assert "teacher" not in manifest(tmp_path)["files"]
+    assert not stored_ids(bot) & set(payout)
+
+
+def test_another_embedding_model_rebuilds_the_index(tmp_path, make_bot):
+    indexed(tmp_path, make_bot)
+
+    bot = make_bot(embedding_model="other-embed")
+    # the other model's collection isn't served
+    assert bot.active_collection is None
+    bot.build_index()
+
+    assert bot.files_to_index == 3
+    assert manifest(tmp_path)["embedding_model"] == "other-embed"
+    assert sorted(path.name for path in (
+        tmp_path / "vector_store").glob("*.npy")) == ["edubot-v2.npy"]
+
+
+def test_a_store_without_a_manifest_is_rebuilt(tmp_path, make_bot):
+    (tmp_path / "vector_store").mkdir()
+    (tmp_path / "vector_store" / "untracked.bin").write_text("stale")
+
+    bot = indexed(tmp_path, make_bot)
+
+    assert not (tmp_path / "vector_store" / "untracked.bin").exists()
+    assert bot.files_to_index == 3
+
+
+def test_legacy_index_files_are_removed(tmp_path, make_bot):
+    (tmp_path / "tracked_student.json").write_text("[]")
+    (tmp_path / "teacher_vector_store").mkdir()
+    (tmp_path / "teacher_vector_store" / "chroma.sqlite3").write_text("")
+
+    indexed(tmp_path, make_bot)
+
+    assert not (tmp_path / "tracked_student.json").exists()
+    assert not (tmp_path / "teacher_vector_store").exists()
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from chatbot import ChatBot
+
+
+def numpy_bot(tmp_path, generations):
+    for generation in generations:
+        for suffix in ("npy", "chunks.json", "bm25.json"):
+            (tmp_path / f"edubot-v{generation}.{suffix}").write_text("")
+
+    return SimpleNamespace(collection_name="edubot", vector_backend="numpy",
+                           db_location=str(tmp_path))
+
+
+def generations(tmp_path):
+    return sorted({int(path.name.split(".")[0].rsplit("-v", 1)[1])
+                   for path in tmp_path.iterdir()})
+
+
+def test_the_previous_generation_is_kept(tmp_path):
+    bot = numpy_bot(tmp_path, [1, 2, 3, 4])
+
+    ChatBot.prune_collections(bot, "edubot-v4")
+
+    assert generations(tmp_path) == [3, 4]
+
+
+def test_leftovers_of_an_interrupted_build_are_dropped(tmp_path):
+    bot = numpy_bot(tmp_path, [2, 3, 4])
+
+    # v4 was being built on top of v3
+    ChatBot.prune_collections(bot, "edubot-v3")
+
+    assert generations(tmp_path) == [2, 3]
+
+
+def test_everything_is_dropped_without_a_collection(tmp_path):
+    bot = numpy_bot(tmp_path, [1])
+    (tmp_path / "other.npy").write_text("")
+
+    ChatBot.prune_collections(bot, None)
+
+    assert [path.name for path in tmp_path.iterdir()] == ["other.npy"]
@@ -0,0 +1,156 @@
+import operator
+from typing import Annotated, Optional, TypedDict
+
+import pytest
+from langgraph.graph import END, START, StateGraph
+
+import utils
+from utils import ExpiringMemorySaver, SQLiteExpiringSaver
+
+
+class Clock():
+    """a settable replacement of time.time()"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class State(TypedDict):
+    log: Annotated[list[str], operator.add]
+    summary: Optional[str]
+
+
+def compile_graph(saver, node=None):
+    def turn(state: State):
+        return {"log": [f"turn {len(state.get('log') or []) + 1}"]}
+
+    builder = StateGraph(State)
+    builder.add_node("turn", node or turn)
+    builder.add_edge(START, "turn")
+    builder.add_edge("turn", END)
+    return builder.compile(checkpointer=saver)
+
+
+def config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(utils.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def saver(request, tmp_path, clock):
+    if request.param == "memory":
+        return ExpiringMemorySaver(inactivity_ttl=60)
+
+    return SQLiteExpiringSaver(
+        inactivity_ttl=60, file_path=str(tmp_path / "sessions.sqlite"))
+
+
+def test_turns_accumulate_in_a_session(saver):
+    graph = compile_graph(saver)
+
+    graph.invoke({"log": []}, config("a"))
+    state = graph.invoke({"log": []}, config("a"))
+
+    assert state["log"] == ["turn 1", "turn 2"]
+    assert saver.has_session("a") and not saver.has_session("b")
+    # only the latest checkpoint is kept
+    assert len(list(saver.list(config("a")))) == 1
+
+
+def test_inactive_sessions_expire(saver, clock):
+    graph = compile_graph(saver)
+    graph.invoke({"log": []}, config("a"))
+    clock.now += 30
+    graph.invoke({"log": []}, config("b"))
+
+    clock.now += 45
+    assert saver.cleanup() == 1
+    assert not saver.has_session("a") and saver.has_session("b")
+    assert saver.get_tuple(config("a")) is None
+    assert saver.get_active_sessions() == 1
+
+    clock.now += 61
+    assert not saver.has_session("b")
+    assert saver.stats()["active_sessions"] == 0
+
+
+def test_deleted_sessions_are_gone(saver):
+    graph = compile_graph(saver)
+    graph.invoke({"log": []}, config("a"))
+
+    saver.delete_thread("a")
+
+    assert not saver.has_session("a")
+    assert graph.get_state(config("a")).values == {}
+
+
+def test_an_update_during_a_turn_keeps_the_turns_values(saver):
+    graph = None
+
+    def turn(state: State):
+        if state.get("summary") is None:
+            return {"log": ["turn 1"], "summary": "first"}
+
+        # e.g. a background summary saved while the next turn runs
+        graph.update_state(
+            config("a"), {"summary": "background"}, as_node="turn")
+        return {"log": ["turn 2"]}
+
+    graph = compile_graph(saver, turn)
+    graph.invoke({"log": []}, config("a"))
+    state = graph.invoke({"log": []}, config("a"))
+
+    assert state == {"log": ["turn 1", "turn 2"], "summary": "first"}
+    assert graph.get_state(config("a")).values == state
+
+
+def test_least_recently_used_sessions_are_evicted(clock):
+    saver = ExpiringMemorySaver(inactivity_ttl=60, max_sessions=2)
+    graph = compile_graph(saver)
+
+    for thread_id in ("a", "b"):
+        graph.invoke({"log": []}, config(thread_id))
+        clock.now += 1
+    graph.get_state(config("a"))
+    clock.now += 1
+    graph.invoke({"log": []}, config("c"))
+
+    assert [saver.has_session(thread_id) for thread_id in "abc"] == [
+        True, False, True]
+    assert saver.stats()["evictions"] == 1
+
+
+def test_sessions_beyond_the_byte_cap_are_evicted(clock):
+    saver = ExpiringMemorySaver(inactivity_ttl=60)
+    graph = compile_graph(saver)
+    graph.invoke({"log": []}, config("a"))
+    session_bytes = saver.stats()["approx_bytes"]
+    assert session_bytes > 0
+
+    saver.max_bytes = session_bytes * 3 // 2
+    clock.now += 1
+    graph.invoke({"log": []}, config("b"))
+
+    # the session being written is never evicted
+    assert not saver.has_session("a") and saver.has_session("b")
+    assert saver.stats()["approx_bytes"] <= saver.max_bytes
+
+
+def test_sqlite_sessions_survive_a_restart(tmp_path, clock):
+    file_path = str(tmp_path / "sessions.sqlite")
+    compile_graph(SQLiteExpiringSaver(60, file_path=file_path)).invoke(
+        {"log": []}, config("a"))
+
+    restarted = SQLiteExpiringSaver(60, file_path=file_path)
+    state = compile_graph(restarted).invoke({"log": []}, config("a"))
+
+    assert state["log"] == ["turn 1", "turn 2"]
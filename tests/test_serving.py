@@ -0,0 +1,40 @@
+import asyncio
+
+
+def write(tmp_path, role, name, text):
+    directory = tmp_path / "data_sources" / role
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / name).write_text(text, encoding="utf-8")
+
+
+def test_a_worker_follows_collections_written_by_another(tmp_path, make_bot):
+    write(tmp_path, "student", "how-do-i-cancel-a-lesson.txt",
+          "open the lesson and press cancel")
+    serving = make_bot()
+    serving.build_index()
+    assert serving.active_collection == "edubot-v1"
+
+    indexing = make_bot()
+    for generation in (2, 3):
+        write(tmp_path, "student", f"article-{generation}.txt",
+              f"the jitsi classroom opens from lesson {generation}")
+        indexing.build_index()
+        assert indexing.active_collection == f"edubot-v{generation}"
+
+    # edubot-v1 was pruned while the first worker served it
+    documents, _ = asyncio.run(serving.asearch("jitsi classroom", "student"))
+
+    assert serving.active_collection == "edubot-v3"
+    assert any("jitsi" in document.page_content for document in documents)
+
+
+def test_the_served_index_is_published_at_once(tmp_path, make_bot):
+    write(tmp_path, "teacher", "how-do-i-get-paid.txt",
+          "payouts are sent every month")
+    bot = make_bot()
+    bot.build_index()
+
+    collection, vector_store, bm25 = bot.serving
+    assert (collection, vector_store, bm25) == (
+        bot.active_collection, bot.vector_store, bot.bm25)
+    assert bm25 is not None
@@ -0,0 +1,84 @@
+import asyncio
+from types import SimpleNamespace
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chatbot import ChatBot
+
+
+def answering_bot():
+    """a bot whose answer llm records the messages it was sent"""
+    sent = []
+
+    async def allm(llm, messages, config=None, name="answer"):
+        sent.append(messages)
+        return AIMessage("answer")
+
+    bot = SimpleNamespace(
+        summary_tasks={}, history_token_budget=None, graph=None,
+        response_cache=None, answer_llm=None, allm=allm)
+    bot.window_messages = lambda messages: ChatBot.window_messages(
+        bot, messages)
+    return bot, sent
+
+
+def answer(bot, messages):
+    config = {"configurable": {"thread_id": "thread", "role": "student"}}
+    return ChatBot.answer_node(bot, {"messages": messages}, config)
+
+
+def test_a_finished_summary_is_used():
+    bot, sent = answering_bot()
+
+    async def run():
+        task = asyncio.create_task(asyncio.sleep(0, "earlier turns"))
+        await task
+        bot.summary_tasks["thread"] = (task, [HumanMessage("old")])
+        return await answer(bot, [HumanMessage("question")])
+
+    update = asyncio.run(run())
+
+    assert update["summary"] == "earlier turns"
+    assert "thread" not in bot.summary_tasks
+    assert "earlier turns" in sent[0][1].content
+    assert [message.content for message in sent[0][2:]] == ["question"]
+
+
+def test_a_running_summary_isnt_awaited():
+    bot, sent = answering_bot()
+    trimmed = [HumanMessage("old question"), AIMessage("old answer")]
+
+    async def run():
+        task = asyncio.create_task(asyncio.sleep(60, "too late"))
+        bot.summary_tasks["thread"] = (task, trimmed)
+        update = await asyncio.wait_for(
+            answer(bot, [HumanMessage("question")]), 1)
+        task.cancel()
+        return update, task
+
+    update, task = asyncio.run(run())
+
+    # the trimmed messages are sent verbatim and the summary is left for
+    # the next turn
+    assert "summary" not in update
+    assert bot.summary_tasks["thread"] == (task, trimmed)
+    assert [message.content for message in sent[0][1:]] == [
+        "old question", "old answer", "question"]
+
+
+def test_a_failed_summary_keeps_the_previous_one():
+    bot, sent = answering_bot()
+
+    async def fail():
+        raise Exception("llm unavailable")
+
+    async def run():
+        task = asyncio.create_task(fail())
+        await asyncio.sleep(0)
+        bot.summary_tasks["thread"] = (task, [HumanMessage("old")])
+        return await answer(bot, [HumanMessage("question")])
+
+    update = asyncio.run(run())
+
+    assert "summary" not in update
+    assert [message.content for message in sent[0][1:]] == ["question"]
@@ -1,9 +1,28 @@
 import os
 import json
 import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional
 
+import numpy as np
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP, BaseCheckpointSaver, CheckpointTuple, get_checkpoint_id,
+    get_checkpoint_metadata)
 from langgraph.checkpoint.memory import MemorySaver
 
+from metrics import saver_seconds, timed
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 
 def is_json_file(file_path: str = "./tracked.json") -> bool:
     """checks if json file exists"""
@@ -21,6 +40,18 @@ def save_to_json(
         json.dump(existing_data, data_file, indent=4)
 
 
+def env_setting(name: str, default, cast=str):
+    """reads an optional setting from the environment"""
+    value = os.getenv(name)
+
+    if value is None:
+        return default
+    if cast is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    return cast(value)
+
+
 def load_from_json(file_path: str = "./tracked.json") -> list:
     """loads data from a json file"""
     retrieved_data: list = []
@@ -45,11 +76,388 @@ def load_from_json(file_path: str = "./tracked.json") -> list:
     return retrieved_data
 
 
+# bump whenever the manifest layout or chunk id scheme changes, a mismatch
+# forces a clean rebuild of the vector stores
+MANIFEST_VERSION = 3
+
+
+def file_fingerprint(file_path: str, tracked: dict | None = None) -> dict:
+    """returns the content hash, mtime and size of a file
+
+    the hash of a tracked file is reused when its mtime and size are unchanged
+    """
+    stat = os.stat(file_path)
+
+    if tracked is not None and (
+            tracked.get("mtime") == stat.st_mtime and
+            tracked.get("size") == stat.st_size):
+        return {"hash": tracked["hash"],
+                "mtime": stat.st_mtime,
+                "size": stat.st_size}
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b""):
+            digest.update(block)
+
+    return {"hash": digest.hexdigest(),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size}
+
+
+def load_manifest(file_path: str = "./manifest.json") -> dict:
+    """loads the ingestion manifest, returns an empty one if it's missing,
+    unreadable or from an older manifest version"""
+    # "collection" is the vector store collection holding the indexed
+    # chunks, every reindex writes to the collection of the next generation
+    empty_manifest = {"version": MANIFEST_VERSION, "files": {},
+                      "collection": None, "generation": 0}
+
+    if not is_json_file(file_path):
+        return empty_manifest
+
+    try:
+        with open(file_path, "r") as data_file:
+            manifest = json.load(data_file)
+    except Exception:
+        return empty_manifest
+
+    if not isinstance(manifest, dict) or (
+            manifest.get("version") != MANIFEST_VERSION):
+        return empty_manifest
+
+    return manifest
+
+
+def save_manifest(
+        manifest: dict, file_path: str = "./manifest.json") -> None:
+    """atomically saves the ingestion manifest"""
+    temp_path = f"{file_path}.tmp"
+
+    with open(temp_path, "w") as data_file:
+        json.dump(manifest, data_file, indent=4)
+
+    os.replace(temp_path, file_path)
+
+
+def manifest_digest(manifest: dict) -> str:
+    """returns a digest of the indexed file contents, it changes whenever the
+    knowledge base does"""
+    contents = {
+        role: {file_name: entry["hash"] for file_name, entry in files.items()}
+        for role, files in manifest["files"].items()}
+
+    return hashlib.sha256(
+        json.dumps(contents, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def diff_directory(
+        data_path: str, tracked: dict,
+        extensions: tuple[str, ...]) -> tuple[dict, list[str], list[str]]:
+    """compares a directory against its manifest entries
+
+    returns the fingerprints of every current file, the files that were added
+    or changed and the files that were removed
+    """
+    fingerprints = {}
+    changed = []
+
+    # a deleted directory removes all of its files
+    file_names = os.listdir(data_path) if os.path.isdir(data_path) else []
+
+    for file_name in sorted(file_names):
+        if not file_name.endswith(extensions):
+            continue
+
+        previous = tracked.get(file_name)
+        fingerprint = file_fingerprint(
+            os.path.join(data_path, file_name), previous)
+        fingerprints[file_name] = fingerprint
+
+        if previous is None or previous.get("hash") != fingerprint["hash"]:
+            changed.append(file_name)
+
+    removed = [
+        file_name for file_name in tracked if file_name not in fingerprints]
+
+    return fingerprints, changed, removed
+
+
+def directory_signature(data_path: str, extensions: tuple[str, ...]) -> str:
+    """returns a cheap digest of the names, mtimes and sizes of the knowledge
+    sources below data_path, it changes whenever a file is added, removed or
+    modified"""
+    entries = []
+
+    for root, _, file_names in os.walk(data_path):
+        for file_name in file_names:
+            if not file_name.endswith(extensions):
+                continue
+
+            stat = os.stat(os.path.join(root, file_name))
+            entries.append((os.path.relpath(root, data_path), file_name,
+                            stat.st_mtime, stat.st_size))
+
+    return hashlib.sha256(
+        json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+class ResponseCache():
+    """semantic cache of final answers keyed by role and query embedding
+
+    a lookup hits when a cached query of the same role is at least
+    `threshold` cosine-similar, entries expire after `ttl` seconds and the
+    least recently used entries are evicted beyond `max_size`. the cache is
+    cleared whenever the knowledge base version changes
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: int = 3600,
+                 max_size: int = 1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # entry id -> (role, normalized query vector, response, created at)
+        self.entries: OrderedDict[int, tuple] = OrderedDict()
+        self.next_id = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def set_version(self, version: str) -> None:
+        """clears the cache when the knowledge base version changes"""
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def _expire(self, now: float) -> None:
+        """drops expired entries"""
+        for entry_id, (_, _, _, created) in list(self.entries.items()):
+            if now - created <= self.ttl:
+                continue
+            del self.entries[entry_id]
+
+    def lookup(self, role: Optional[str],
+               vector: list[float]) -> Optional[str]:
+        """returns the cached response of the most similar query"""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        with self.lock:
+            self._expire(time.time())
+
+            candidates = [
+                (entry_id, entry) for entry_id, entry in self.entries.items()
+                if entry[0] == role]
+
+            if candidates:
+                similarities = np.stack(
+                    [entry[1] for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry[2]
+
+            self.misses += 1
+            return None
+
+    def store(self, role: Optional[str], vector: list[float],
+              response: str) -> None:
+        """caches the response to a query"""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        with self.lock:
+            self.entries[self.next_id] = (role, query, response, time.time())
+            self.next_id += 1
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """returns hit and miss counters"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "threshold": self.threshold
+            }
+
+
+@contextmanager
+def index_lock(file_path: str = "./index.lock", blocking: bool = True):
+    """serializes indexing across processes (e.g. uvicorn workers) sharing
+    the same vector store, a no-op where file locks aren't available
+
+    yields whether the lock is held, without blocking it isn't waited for
+    when another process holds it
+    """
+    with open(file_path, "w") as lock_file:
+        acquired = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (
+                    0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                acquired = False
+        try:
+            yield acquired
+        finally:
+            if fcntl is not None and acquired:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class QueueFullError(Exception):
+    """raised when the llm wait queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("llm queue is full")
+        self.retry_after = retry_after
+
+
+class QueueTimeoutError(Exception):
+    """raised when a request's deadline passes while it waits for an llm"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("timed out waiting for the llm queue")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter():
+    """limits concurrent llm calls with a bounded wait queue
+
+    at most `max_concurrency` calls run at once and at most `max_queue`
+    wait, further calls are rejected immediately. a waiting call gives up
+    after `queue_timeout` seconds or at its own deadline, whichever is first
+    """
+
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 32,
+                 queue_timeout: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # moving average of how long a call holds its slot
+        self.average_service = 1.0
+
+    def is_full(self) -> bool:
+        """checks if a new call would be rejected"""
+        return self.waiting >= self.max_queue
+
+    def retry_after(self) -> int:
+        """estimates the seconds until the queue has drained"""
+        backlog = (self.waiting + self.active) / self.max_concurrency
+        return max(1, int(backlog * self.average_service + 0.5))
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None):
+        """waits for an llm slot, deadline is a time.monotonic() value"""
+        if self.semaphore.locked() and self.is_full():
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise QueueTimeoutError(self.retry_after())
+        finally:
+            self.waiting -= 1
+
+        admitted = time.monotonic()
+        wait = admitted - started
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+            self.average_service = (
+                0.9 * self.average_service +
+                0.1 * (time.monotonic() - admitted))
+
+    def stats(self) -> dict:
+        """returns queue depth and wait times"""
+        return {
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "average_wait_ms": round(
+                1000 * self.total_wait / self.admitted, 2)
+            if self.admitted else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait, 2)
+        }
+
+
+def estimate_tokens(text: str) -> int:
+    """roughly estimates the number of llm tokens in a text
+    (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+
 class ExpiringMemorySaver(MemorySaver):
-    def __init__(self, inactivity_ttl: int):
+    """in-memory checkpoint saver with inactivity expiry and memory caps
+
+    sessions are kept in access order, with a single inactivity ttl the
+    least recently used session is also the next one to expire, so expiry
+    (lazy on access and in cleanup()) costs O(expired sessions). beyond
+    `max_sessions` sessions or `max_bytes` approximate serialized bytes the
+    least recently used sessions are evicted. all operations are guarded by
+    a lock since langgraph may call the saver from executor threads
+    """
+
+    def __init__(self, inactivity_ttl: int, keep_checkpoints: int = 1,
+                 max_sessions: Optional[int] = None,
+                 max_bytes: Optional[int] = None):
         super().__init__()
-        self.last_access = {}
+        # thread id -> last access time, least recently used first
+        self.last_access: OrderedDict[str, float] = OrderedDict()
         self.inactivity_ttl = inactivity_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+
+        # only the latest checkpoints of a thread are kept, older ones (and
+        # the channel values only they reference) are dropped on every put
+        self.keep_checkpoints = keep_checkpoints
+        # thread id -> blob keys written for the thread
+        self.thread_blobs = {}
+        # thread id -> approximate serialized size of the thread
+        self.thread_bytes = {}
+        self.total_bytes = 0
+
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.RLock()
 
     # def put(self, thread_id, state):
     #     super().put(thread_id, state)
@@ -61,41 +469,509 @@ class ExpiringMemorySaver(MemorySaver):
     #         self.last_access[thread_id] = time()
     #     return state
 
+    def _touch(self, thread_id: str) -> None:
+        self.last_access[thread_id] = time.time()
+        self.last_access.move_to_end(thread_id)
+
+    def _expire(self) -> int:
+        """drops expired sessions, oldest first"""
+        expired = 0
+        deadline = time.time() - self.inactivity_ttl
+
+        while self.last_access:
+            thread_id, last_access = next(iter(self.last_access.items()))
+            if last_access >= deadline:
+                break
+            self.drop_thread(thread_id)
+            expired += 1
+
+        self.expirations += expired
+        return expired
+
+    def _measure(self, thread_id: str) -> None:
+        """updates the approximate serialized size of a thread"""
+        size = 0
+
+        for checkpoint_ns, checkpoints in self.storage.get(
+                thread_id, {}).items():
+            for checkpoint_id, (checkpoint, metadata, _) in (
+                    checkpoints.items()):
+                size += len(checkpoint[1]) + len(metadata[1])
+                for _, _, value, _ in self.writes.get(
+                        (thread_id, checkpoint_ns, checkpoint_id),
+                        {}).values():
+                    size += len(value[1])
+
+        for key in self.thread_blobs.get(thread_id, ()):
+            if (blob := self.blobs.get(key)) is not None:
+                size += len(blob[1])
+
+        self.total_bytes += size - self.thread_bytes.get(thread_id, 0)
+        self.thread_bytes[thread_id] = size
+
+    def _evict(self, current_thread_id: str) -> None:
+        """evicts least recently used sessions beyond the caps"""
+        while len(self.last_access) > 1 and (
+                (self.max_sessions is not None and
+                 len(self.last_access) > self.max_sessions) or
+                (self.max_bytes is not None and
+                 self.total_bytes > self.max_bytes)):
+            thread_id = next(iter(self.last_access))
+            if thread_id == current_thread_id:
+                break
+            self.drop_thread(thread_id)
+            self.evictions += 1
+
     def put(self, *args, **kwargs):
         """Accept any arguments and pass to parent"""
-        result = super().put(*args, **kwargs)
+        with self.lock, timed(saver_seconds, "put", timing="saver"):
+            result = super().put(*args, **kwargs)
+
+            # Try to extract thread_id from first argument (config)
+            if args and isinstance(args[0], dict):
+                config = args[0]
+                thread_id = config.get("configurable", {}).get(
+                    "thread_id", "default")
+                self._touch(thread_id)
+
+                checkpoint_ns = config["configurable"].get(
+                    "checkpoint_ns", "")
+                new_versions = (
+                    args[3] if len(args) > 3
+                    else kwargs.get("new_versions", {}))
+                self.thread_blobs.setdefault(thread_id, set()).update(
+                    (thread_id, checkpoint_ns, channel, version)
+                    for channel, version in new_versions.items())
+
+                self.prune(thread_id, checkpoint_ns)
+                self._measure(thread_id)
+                self._expire()
+                self._evict(thread_id)
 
-        # Try to extract thread_id from first argument (config)
-        if args and isinstance(args[0], dict):
-            config = args[0]
-            thread_id = config.get("configurable", {}).get(
-                "thread_id", "default")
-            self.last_access[thread_id] = time.time()
+            return result
 
-        return result
+    def put_writes(self, config: dict, writes, task_id: str,
+                   task_path: str = "") -> None:
+        """saves pending writes, counting them towards the thread's size"""
+        with self.lock, timed(saver_seconds, "put_writes", timing="saver"):
+            super().put_writes(config, writes, task_id, task_path)
+
+            thread_id = config["configurable"]["thread_id"]
+            if thread_id in self.last_access:
+                self._measure(thread_id)
+
+    def list(self, *args, **kwargs):
+        with self.lock, timed(saver_seconds, "list", timing="saver"):
+            return iter(list(super().list(*args, **kwargs)))
+
+    def prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        """drops all but the latest checkpoints of a thread
+
+        the channel values of the checkpoints the kept ones were forked from
+        are kept too, a run still in progress (e.g. when the state was
+        updated meanwhile) writes its next checkpoint on top of its parent
+        """
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.keep_checkpoints:
+            return
+
+        kept = sorted(checkpoints)[-self.keep_checkpoints:]
+        referenced = set()
+        for checkpoint_id in {*kept, *(
+                checkpoints[checkpoint_id][2] for checkpoint_id in kept)}:
+            if checkpoint_id not in checkpoints:
+                continue
+            referenced.update(
+                (thread_id, checkpoint_ns, channel, version)
+                for channel, version in self.serde.loads_typed(
+                    checkpoints[checkpoint_id][0])[
+                        "channel_versions"].items())
+
+        for checkpoint_id in sorted(checkpoints)[:-self.keep_checkpoints]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        blob_keys = self.thread_blobs.get(thread_id, set())
+        for key in [key for key in blob_keys
+                    if key[1] == checkpoint_ns and key not in referenced]:
+            self.blobs.pop(key, None)
+            blob_keys.discard(key)
+
+    def drop_thread(self, thread_id: str) -> None:
+        """removes a thread's checkpoints, writes and channel values"""
+        with self.lock:
+            for checkpoint_ns, checkpoints in self.storage.pop(
+                    thread_id, {}).items():
+                for checkpoint_id in checkpoints:
+                    self.writes.pop(
+                        (thread_id, checkpoint_ns, checkpoint_id), None)
+
+            for key in self.thread_blobs.pop(thread_id, ()):
+                self.blobs.pop(key, None)
+
+            self.total_bytes -= self.thread_bytes.pop(thread_id, 0)
+            self.last_access.pop(thread_id, None)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.drop_thread(thread_id)
 
     def get_tuple(self, config: dict):
-        """Track access on retrieval"""
-        result = super().get_tuple(config)
+        """Track access on retrieval, expired sessions aren't returned"""
+        with self.lock, timed(saver_seconds, "get_tuple", timing="saver"):
+            self._expire()
+            result = super().get_tuple(config)
 
-        if result is not None:
-            thread_id = config.get("configurable", {}).get(
-                "thread_id", "default")
-            self.last_access[thread_id] = time.time()
+            if result is not None:
+                thread_id = config.get("configurable", {}).get(
+                    "thread_id", "default")
+                self._touch(thread_id)
 
-        return result
+            return result
 
     def cleanup(self):
-        now = time.time()
-        expired = [
-            tid for tid, ts in self.last_access.items()
-            if now - ts > self.inactivity_ttl]
-        for tid in expired:
-            self.storage.pop(tid, None)
-            self.last_access.pop(tid, None)
+        """removes expired sessions, returns how many were removed"""
+        with self.lock, timed(saver_seconds, "cleanup"):
+            return self._expire()
+
+    def has_session(self, thread_id: str) -> bool:
+        """checks if a session exists and hasn't expired"""
+        with self.lock:
+            self._expire()
+            return thread_id in self.last_access
+
+    def get_active_sessions(self):
+        """Get count of currently active sessions"""
+        with self.lock:
+            self._expire()
+            return len(self.last_access)
+
+    def stats(self) -> dict:
+        """returns session counts and approximate memory use"""
+        with self.lock:
+            self._expire()
+            return {
+                "active_sessions": len(self.last_access),
+                "approx_bytes": self.total_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes
+            }
+
+
+class SQLiteExpiringSaver(BaseCheckpointSaver[str]):
+    """checkpoint saver backed by a sqlite file in WAL mode
+
+    drop-in replacement for ExpiringMemorySaver that several processes
+    (uvicorn workers or pods on a shared volume) can use at once and that
+    survives restarts. sessions expire after `inactivity_ttl` seconds without
+    access, lazily on access and in bulk through the indexed cleanup()
+    """
+
+    def __init__(self, inactivity_ttl: int,
+                 file_path: str = "./sessions.sqlite",
+                 keep_checkpoints: int = 1):
+        super().__init__()
+        self.inactivity_ttl = inactivity_ttl
+        self.file_path = file_path
+        self.keep_checkpoints = keep_checkpoints
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(
+            file_path, check_same_thread=False, timeout=30)
+        self.connection.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (
+                    thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                thread_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_last_access
+                ON sessions (last_access);
+            """)
+        self.connection.commit()
+
+    @contextmanager
+    def cursor(self):
+        """yields a cursor, committing once the block is done"""
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                yield cursor
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _touch(self, cursor, thread_id: str) -> None:
+        cursor.execute(
+            "INSERT OR REPLACE INTO sessions (thread_id, last_access) "
+            "VALUES (?, ?)", (thread_id, time.time()))
+
+    def _delete(self, cursor, thread_ids: list[str]) -> None:
+        for table in ("checkpoints", "writes", "sessions"):
+            cursor.executemany(
+                f"DELETE FROM {table} WHERE thread_id = ?",
+                [(thread_id,) for thread_id in thread_ids])
+
+    def _is_expired(self, cursor, thread_id: str) -> bool:
+        row = cursor.execute(
+            "SELECT last_access FROM sessions WHERE thread_id = ?",
+            (thread_id,)).fetchone()
+        return row is not None and (
+            time.time() - row[0] > self.inactivity_ttl)
+
+    def _tuple(self, cursor, thread_id, checkpoint_ns, checkpoint_id,
+               parent_checkpoint_id, type_, checkpoint, metadata_type,
+               metadata) -> CheckpointTuple:
+        writes = cursor.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? "
+            "ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=({"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((type_, value)))
+                for task_id, channel, type_, value in writes])
+
+    def get_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        """returns a checkpoint of a live session and tracks the access"""
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        columns = (
+            "thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+            "type, checkpoint, metadata_type, metadata")
+
+        with (timed(saver_seconds, "get_tuple", timing="saver"),
+              self.cursor() as cursor):
+            if self._is_expired(cursor, thread_id):
+                self._delete(cursor, [thread_id])
+                return None
+
+            if checkpoint_id := get_checkpoint_id(config):
+                row = cursor.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? "
+                    "AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+            else:
+                row = cursor.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? "
+                    "AND checkpoint_ns = ? ORDER BY checkpoint_id DESC "
+                    "LIMIT 1", (thread_id, checkpoint_ns)).fetchone()
+
+            if row is None:
+                return None
+
+            self._touch(cursor, thread_id)
+            return self._tuple(cursor, *row)
+
+    def list(self, config: Optional[dict], *, filter: Optional[dict] = None,
+             before: Optional[dict] = None, limit: Optional[int] = None):
+        """yields checkpoints, newest first"""
+        query = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, "
+            "parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints")
+        clauses, parameters = [], []
+
+        if config is not None:
+            clauses.append("thread_id = ?")
+            parameters.append(str(config["configurable"]["thread_id"]))
+            if (checkpoint_ns := config["configurable"].get(
+                    "checkpoint_ns")) is not None:
+                clauses.append("checkpoint_ns = ?")
+                parameters.append(checkpoint_ns)
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            clauses.append("checkpoint_id < ?")
+            parameters.append(before_id)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.cursor() as cursor:
+            rows = cursor.execute(query, parameters).fetchall()
+            tuples = [self._tuple(cursor, *row) for row in rows]
+
+        returned = 0
+        for checkpoint_tuple in tuples:
+            if filter and any(
+                    checkpoint_tuple.metadata.get(key) != value
+                    for key, value in filter.items()):
+                continue
+            if limit is not None and returned >= limit:
+                return
+            returned += 1
+            yield checkpoint_tuple
+
+    def put(self, config: dict, checkpoint: dict, metadata: dict,
+            new_versions: dict) -> dict:
+        """saves a checkpoint, only the latest checkpoints are kept"""
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+
+        with (timed(saver_seconds, "put", timing="saver"),
+              self.cursor() as cursor):
+            cursor.execute(
+                "INSERT OR REPLACE INTO checkpoints (thread_id, "
+                "checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, "
+                "checkpoint, metadata_type, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"],
+                 config["configurable"].get("checkpoint_id"),
+                 *self.serde.dumps_typed(checkpoint),
+                 *self.serde.dumps_typed(
+                     get_checkpoint_metadata(config, metadata))))
+
+            kept = [row[0] for row in cursor.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? "
+                "AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT ?",
+                (thread_id, checkpoint_ns, self.keep_checkpoints))]
+            placeholders = ", ".join("?" * len(kept))
+            for table in ("checkpoints", "writes"):
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND "
+                    f"checkpoint_ns = ? AND checkpoint_id NOT IN "
+                    f"({placeholders})", (thread_id, checkpoint_ns, *kept))
+
+            self._touch(cursor, thread_id)
+
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: dict, writes, task_id: str,
+                   task_path: str = "") -> None:
+        """saves the pending writes of a task"""
+        # special channels are overwritten, regular writes are kept once
+        verb = ("INSERT OR REPLACE" if all(
+            channel in WRITES_IDX_MAP for channel, _ in writes)
+            else "INSERT OR IGNORE")
+
+        with (timed(saver_seconds, "put_writes", timing="saver"),
+              self.cursor() as cursor):
+            cursor.executemany(
+                f"{verb} INTO writes (thread_id, checkpoint_ns, "
+                "checkpoint_id, task_id, idx, channel, type, value, "
+                "task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(str(config["configurable"]["thread_id"]),
+                  config["configurable"].get("checkpoint_ns", ""),
+                  str(config["configurable"]["checkpoint_id"]),
+                  task_id, WRITES_IDX_MAP.get(channel, index), channel,
+                  *self.serde.dumps_typed(value), task_path)
+                 for index, (channel, value) in enumerate(writes)])
+
+    def delete_thread(self, thread_id: str) -> None:
+        """removes a session and its checkpoints"""
+        with self.cursor() as cursor:
+            self._delete(cursor, [str(thread_id)])
+
+    async def aget_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[dict], *,
+                    filter: Optional[dict] = None,
+                    before: Optional[dict] = None,
+                    limit: Optional[int] = None):
+        for checkpoint_tuple in await asyncio.to_thread(
+                lambda: list(self.list(
+                    config, filter=filter, before=before, limit=limit))):
+            yield checkpoint_tuple
+
+    async def aput(self, config: dict, checkpoint: dict, metadata: dict,
+                   new_versions: dict) -> dict:
+        return await asyncio.to_thread(
+            self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: dict, writes, task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(
+            self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current: Optional[str], channel) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    def cleanup(self):
+        """removes expired sessions, returns how many were removed"""
+        with self.cursor() as cursor:
+            expired = [row[0] for row in cursor.execute(
+                "SELECT thread_id FROM sessions WHERE last_access < ?",
+                (time.time() - self.inactivity_ttl,))]
+            self._delete(cursor, expired)
 
         return len(expired)
 
+    def has_session(self, thread_id: str) -> bool:
+        """checks if a session exists and hasn't expired"""
+        with self.cursor() as cursor:
+            row = cursor.execute(
+                "SELECT last_access FROM sessions WHERE thread_id = ?",
+                (str(thread_id),)).fetchone()
+
+        return row is not None and (
+            time.time() - row[0] <= self.inactivity_ttl)
+
     def get_active_sessions(self):
         """Get count of currently active sessions"""
-        return len(self.last_access)
+        with self.cursor() as cursor:
+            return cursor.execute(
+                "SELECT COUNT(*) FROM sessions WHERE last_access >= ?",
+                (time.time() - self.inactivity_ttl,)).fetchone()[0]
+
+    def stats(self) -> dict:
+        """returns session counts and the database size"""
+        return {
+            "active_sessions": self.get_active_sessions(),
+            "approx_bytes": sum(
+                os.path.getsize(path)
+                for path in (self.file_path, f"{self.file_path}-wal")
+                if os.path.exists(path))
+        }